@@ -4,8 +4,9 @@ import warnings
 from tensorboardX import SummaryWriter
 
 from callbacks.tensorboard import TensorBoard, EmbeddingGrapher
-from callbacks.magnet_updates import UpdateClusters, UpdateLosses, SetClusterMeans, SetEvalVariance
+from callbacks.magnet_updates import UpdateClusters, UpdateClustersMiniBatch, UpdateLosses, SetClusterMeans, SetEvalVariance
 from callbacks.repmet_updates import UpdateReps, UpdateValReps
+from utils.embedding_bank import EmbeddingBank
 
 
 def initialize_callbacks(config, model, datasets, samplers, dataloaders, losses, optimizer):
@@ -38,18 +39,32 @@ def initialize_callbacks(config, model, datasets, samplers, dataloaders, losses,
 
     elif config.run_type == 'magnetloss':
 
-        callbacks['epoch_start'] = [UpdateClusters(every=1, dataloader=dataloaders['train'], dataset=datasets['train'], batch_size=config.train.for_bs)]
+        bank = initialize_bank(config, datasets['train'])
+        plot_bank = bank if config.vis.plot_bank else None
+        forward_options = initialize_forward_options(config)
 
-        callbacks['batch_end'] = [TensorBoard(every=config.vis.every, tb_sw=tb_sw),
-                                  EmbeddingGrapher(every=config.vis.plot_embed_every, tb_sw=tb_sw, tag='train', label_image=True),
-                                  UpdateLosses(every=1, dataloader=dataloaders['train']),
-                                  UpdateClusters(every=10, dataloader=dataloaders['train'], dataset=datasets['train'], batch_size=config.train.for_bs)]
+        if config.train.cluster_update == 'minibatch':
+            # Only re-embed the entire training set every few epochs, in between update the clusters with the
+            # embeddings of each training batch
+            callbacks['epoch_start'] = [UpdateClusters(every=config.train.full_cluster_update_every, dataloader=dataloaders['train'], dataset=datasets['train'], batch_size=config.train.for_bs, by_epoch=True, bank=bank, forward_options=forward_options)]
+
+            callbacks['batch_end'] = [TensorBoard(every=config.vis.every, tb_sw=tb_sw),
+                                      EmbeddingGrapher(every=config.vis.plot_embed_every, tb_sw=tb_sw, tag='train', label_image=True, bank=plot_bank),
+                                      UpdateLosses(every=1, dataloader=dataloaders['train']),
+                                      UpdateClustersMiniBatch(every=1, dataloader=dataloaders['train'], bank=bank)]
+        else:
+            callbacks['epoch_start'] = [UpdateClusters(every=1, dataloader=dataloaders['train'], dataset=datasets['train'], batch_size=config.train.for_bs, bank=bank, forward_options=forward_options)]
+
+            callbacks['batch_end'] = [TensorBoard(every=config.vis.every, tb_sw=tb_sw),
+                                      EmbeddingGrapher(every=config.vis.plot_embed_every, tb_sw=tb_sw, tag='train', label_image=True, bank=plot_bank),
+                                      UpdateLosses(every=1, dataloader=dataloaders['train']),
+                                      UpdateClusters(every=10, dataloader=dataloaders['train'], dataset=datasets['train'], batch_size=config.train.for_bs, bank=bank, forward_options=forward_options)]
 
         callbacks['epoch_end'] = [TensorBoard(every=config.vis.every, tb_sw=tb_sw)]
 
         # Update the validation clusters with training data and set them in the val loss with the variance from training
         # so we can perform the evaluation
-        callbacks['validation_start'] = [UpdateClusters(every=1, dataloader=dataloaders['train'], dataset=datasets['train'], batch_size=config.train.for_bs),
+        callbacks['validation_start'] = [UpdateClusters(every=1, dataloader=dataloaders['train'], dataset=datasets['train'], batch_size=config.train.for_bs, bank=bank, forward_options=forward_options),
                                          SetClusterMeans(every=1, eval_loss=losses['val'], dataloader=dataloaders['train']),
                                          SetEvalVariance(every=1, eval_loss=losses['val'], training_loss=losses['train'])]
 
@@ -57,10 +72,15 @@ def initialize_callbacks(config, model, datasets, samplers, dataloaders, losses,
                                        EmbeddingGrapher(every=config.vis.plot_embed_every, tb_sw=tb_sw, tag='val', label_image=True)]
 
     elif config.run_type == 'repmet':
-        callbacks['training_start'] = [UpdateReps(every=1, dataset=datasets['train'], batch_size=config.train.for_bs)]
+
+        bank = initialize_bank(config, datasets['train'])
+        plot_bank = bank if config.vis.plot_bank else None
+        forward_options = initialize_forward_options(config)
+
+        callbacks['training_start'] = [UpdateReps(every=1, dataset=datasets['train'], batch_size=config.train.for_bs, bank=bank, forward_options=forward_options)]
 
         callbacks['batch_end'] = [TensorBoard(every=config.vis.every, tb_sw=tb_sw),
-                                  EmbeddingGrapher(every=config.vis.plot_embed_every, tb_sw=tb_sw, tag='train', label_image=True)]
+                                  EmbeddingGrapher(every=config.vis.plot_embed_every, tb_sw=tb_sw, tag='train', label_image=True, bank=plot_bank)]
 
         callbacks['epoch_end'] = [TensorBoard(every=config.vis.every, tb_sw=tb_sw)]
 
@@ -81,3 +101,22 @@ def initialize_callbacks(config, model, datasets, samplers, dataloaders, losses,
         warnings.warn(config.run_type + "not recognised, no callbacks initialised.")
 
     return callbacks
+
+
+def initialize_bank(config, dataset):
+    """The EmbeddingBank of the training set shared by the cluster / rep updates and the embedding plots"""
+    if config.train.bank_memmap:
+        path = os.path.join(config.model.root_dir, config.model.type, config.model.id, config.run_id, 'embeddings.dat')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    else:
+        path = None
+    return EmbeddingBank(len(dataset), dtype=config.train.bank_dtype, path=path)
+
+
+def initialize_forward_options(config):
+    """The loader and precision options of the forward passes over the training set"""
+    return {'num_workers': config.train.for_workers,
+            'pin_memory': config.train.for_pin_memory,
+            'prefetch_factor': config.train.for_prefetch_factor,
+            'amp': config.train.for_amp,
+            'channels_last': config.train.for_channels_last}
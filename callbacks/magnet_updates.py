@@ -5,24 +5,47 @@ from utils.model_forward import forward
 
 
 class UpdateClusters(object):
-    def __init__(self, every, dataloader, dataset, batch_size=64):
+    def __init__(self, every, dataloader, dataset, batch_size=64, by_epoch=False, bank=None, forward_options=None):
         self.every = every
         self.dataloader = dataloader
         self.dataset = dataset
         self.batch_size = batch_size
+        self.by_epoch = by_epoch  # count every in epochs rather than steps
+        self.bank = bank  # EmbeddingBank to embed the training set into
+        self.forward_options = forward_options or {}  # loader / amp options for utils.model_forward.forward
 
     def __call__(self, epoch, batch, step, model, dataloaders, losses, optimizer, data, stats):
-        if step % self.every == 0:
+        # always when the sampler has no clusters yet (eg. resuming part way through a cycle), it can't make batches
+        if self.dataloader.batch_sampler.centroids is None or (epoch if self.by_epoch else step) % self.every == 0:
             print('Updating Clusters')
             outputs, labels = forward(model=model,
                                       dataset=self.dataset,
-                                      batch_size=self.batch_size)
+                                      batch_size=self.batch_size,
+                                      bank=self.bank,
+                                      stamp=step,
+                                      **self.forward_options)
 
             # todo check these labels match those in the batch sampler
 
             self.dataloader.batch_sampler.update_clusters(outputs)
 
 
+class UpdateClustersMiniBatch(object):
+    def __init__(self, every, dataloader, bank=None):
+        self.every = every
+        self.dataloader = dataloader
+        self.bank = bank  # EmbeddingBank to keep up to date with the training batch embeddings
+
+    def __call__(self, epoch, batch, step, model, dataloaders, losses, optimizer, data, stats):
+        if step % self.every == 0:
+            # use the embeddings of the training batch rather than re-embedding the entire set
+            outputs = data['outputs'].detach().cpu().numpy()
+            if self.bank is not None:
+                self.bank.update(self.dataloader.batch_sampler.batch_indexes, outputs,
+                                 labels=data['labels'].cpu().numpy(), stamp=step)
+            self.dataloader.batch_sampler.update_clusters_minibatch(outputs)
+
+
 class UpdateLosses(object):
     def __init__(self, every, dataloader):
         self.every = every
@@ -43,8 +66,8 @@ class SetClusterMeans(object):
     def __call__(self, epoch, batch, step, model, dataloaders, losses, optimizer, data, stats):
         if step % self.every == 0:
             # ensure performed after an UpdateClusters() callback
-            self.eval_loss.cluster_means = self.dataloader.batch_sampler.centroids
-            self.eval_loss.cluster_classes = self.dataloader.batch_sampler.cluster_classes
+            self.eval_loss.set_clusters(self.dataloader.batch_sampler.centroids,
+                                        self.dataloader.batch_sampler.cluster_classes)
 
 
 class SetEvalVariance(object):
@@ -55,4 +78,4 @@ class SetEvalVariance(object):
 
     def __call__(self, epoch, batch, step, model, dataloaders, losses, optimizer, data, stats):
         if step % self.every == 0:
-            self.eval_loss.variance = torch.mean(self.training_loss.variances)
+            self.eval_loss.variance = self.training_loss.mean_variance()
@@ -1,33 +1,36 @@
 from utils.model_forward import forward
-from sklearn.cluster import KMeans
+from utils.kmeans import batched_kmeans
 
 
 class UpdateReps(object):
-    def __init__(self, every, dataset, batch_size=64):
+    def __init__(self, every, dataset, batch_size=64, bank=None, forward_options=None):
         self.every = every
         self.dataset = dataset
         self.batch_size = batch_size
+        self.bank = bank  # EmbeddingBank to embed the training set into
+        self.forward_options = forward_options or {}  # loader / amp options for utils.model_forward.forward
+        self.centroids = None
 
     def __call__(self, epoch, batch, step, model, dataloaders, losses, optimizer, data, stats):
         if step % self.every == 0:
             print('Updating Reps')
             outputs, labels = forward(model=model,
                                       dataset=self.dataset,
-                                      batch_size=self.batch_size)
+                                      batch_size=self.batch_size,
+                                      bank=self.bank,
+                                      stamp=step,
+                                      **self.forward_options)
 
             N = losses['train'].N  # todo might be a nicer way to get these
             k = losses['train'].k
 
-            for c in range(N):
-                class_mask = labels == c
-                class_examples = outputs[class_mask]
-                kmeans = KMeans(n_clusters=k, init='k-means++', n_init=1, max_iter=20)
-                kmeans.fit(class_examples)
+            # Cluster all classes at once, warm starting from the current reps if they've been set or trained (they've
+            # moved on from the centroids of the last update), k-means++ if they're still the random initialisation
+            reps = losses['train'].reps
+            init_centroids = reps.detach() if getattr(reps, 'rep_version', 0) > 0 else None
+            self.centroids, _ = batched_kmeans(outputs, labels, N, k, init_centroids=init_centroids, max_iter=20)
 
-                start = c * k
-                stop = (c+1) * k
-                # losses['train'].reps.data[start:stop] = torch.Tensor(kmeans.cluster_centers_).cuda().float()
-                losses['train'].set_reps(kmeans.cluster_centers_, start, stop)
+            losses['train'].set_reps(self.centroids)
 
 
 class UpdateValReps(object):
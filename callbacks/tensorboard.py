@@ -28,24 +28,31 @@ class TensorBoard(object):
                     else:
                         self.tb_sw.add_scalar(tag=k, scalar_value=v, global_step=step)
 
-            if hasattr(losses['train'], 'variances'):
-                self.tb_sw.add_scalar(tag='variances', scalar_value=losses['train'].variances[-1], global_step=step)
+            if getattr(losses['train'], 'last_variance', None) is not None:
+                self.tb_sw.add_scalar(tag='variances', scalar_value=losses['train'].last_variance.item(), global_step=step)
 
 
 class EmbeddingGrapher(object):
 
-    def __init__(self, every, tb_sw, tag, label_image=False):
+    def __init__(self, every, tb_sw, tag, label_image=False, bank=None):
         self.every = every
         self.tb_sw = tb_sw
         self.tag = tag
         self.label_image = label_image
+        self.bank = bank  # if given plot the embedded samples of this EmbeddingBank rather than the batch
 
     def __call__(self, epoch, batch, step, model, dataloaders, losses, optimizer, data, stats):
 
         if step % self.every == 0:
-            inputs = data['inputs']
-            outputs = data['outputs'].cpu().detach().numpy()
-            labels = data['labels'].cpu().detach().numpy()
+            if self.bank is not None and self.bank.embeddings is not None:
+                inputs = None
+                embedded = self.bank.embedded()
+                outputs = np.asarray(self.bank.embeddings[embedded], dtype=np.float32)
+                labels = self.bank.labels[embedded]
+            else:
+                inputs = data['inputs']
+                outputs = data['outputs'].cpu().detach().numpy()
+                labels = data['labels'].cpu().detach().numpy()
 
             if 'test' in losses.keys():
                 lk = 'test'
@@ -61,7 +68,7 @@ class EmbeddingGrapher(object):
                 labels = list(labels)+rep_labels
                 self.label_image = False
 
-            if self.label_image:
+            if self.label_image and inputs is not None:
                 self.tb_sw.add_embedding(outputs, metadata=labels, label_img=inputs, global_step=step, tag=self.tag)
             else:
                 self.tb_sw.add_embedding(outputs, metadata=labels, global_step=step, tag=self.tag)
@@ -96,7 +96,10 @@ def evaluate():
                                           split='test')
 
     dataloaders = dict()
-    dataloaders['test'] = torch.utils.data.DataLoader(datasets['test'], batch_sampler=samplers['test'])
+    if samplers['test'] is not None:
+        dataloaders['test'] = torch.utils.data.DataLoader(datasets['test'], batch_sampler=samplers['test'])
+    else:
+        dataloaders['test'] = torch.utils.data.DataLoader(datasets['test'], batch_size=config.test.batch_size)
 
     #################### LOSSES + METRICS ######################
     # Setup losses
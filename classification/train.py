@@ -24,6 +24,7 @@ from utils.checkpointing import save_checkpoint, load_checkpoint
 
 from model_definitions.initialize import initialize_model
 from data_loading.initialize import initialize_dataset, initialize_sampler
+from data_loading.samplers import PrefetchBatchSampler
 from losses.initialize import initialize_loss
 from callbacks.initialize import initialize_callbacks
 
@@ -101,6 +102,8 @@ def train():
                                            sampler_name=config.train.sampler,
                                            dataset=datasets['train'],
                                            split='train')
+    if config.train.prefetch_batches > 0:
+        samplers['train'] = PrefetchBatchSampler(samplers['train'], n_batches=config.train.prefetch_batches)
     if config.val.every > 0:
         samplers['val'] = initialize_sampler(config=config,
                                              sampler_name=config.val.sampler,
@@ -110,7 +113,10 @@ def train():
     dataloaders = dict()
     dataloaders['train'] = torch.utils.data.DataLoader(datasets['train'], batch_sampler=samplers['train'])
     if config.val.every > 0:
-        dataloaders['val'] = torch.utils.data.DataLoader(datasets['val'], batch_sampler=samplers['val'])
+        if samplers['val'] is not None:
+            dataloaders['val'] = torch.utils.data.DataLoader(datasets['val'], batch_sampler=samplers['val'])
+        else:
+            dataloaders['val'] = torch.utils.data.DataLoader(datasets['val'], batch_size=config.val.batch_size)
 
     #################### LOSSES + METRICS ######################
     # Setup losses
@@ -237,6 +243,8 @@ def fit(config,
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
+            if hasattr(losses['train'], 'reps_changed'):
+                losses['train'].reps_changed()  # the reps may have been stepped, (re)build any rep index on next use
 
             # statistics
             train_loss.append(loss.item())
@@ -27,6 +27,11 @@ config.model.id = None
 config.model.emb_size = '' # num classes when not emb
 config.model.dist = 'euc'
 
+# repmet, approximate nearest rep index used in evaluation (val + test)
+config.model.rep_index_lists = 0  # number of coarse lists the reps are clustered into, 0 scores every rep (no index)
+config.model.rep_index_probe = 8  # number of closest lists searched per sample
+config.model.rep_index_top_l = 128  # number of closest reps scored per sample
+
 config.model.backbone = edict()
 config.model.backbone.type = 'resnet'
 config.model.backbone.n_layers = 101
@@ -54,6 +59,7 @@ config.dataset.classes = ''
 # detection
 config.dataset.use_flipped = True
 config.dataset.use_difficult = False
+config.dataset.image_cache = None  # dir of the pre-resized image shards (python -m data_loading.image_cache), None decodes each sample
 
 # Train Defaults
 config.train = edict()
@@ -62,7 +68,16 @@ config.train.loss = None
 
 config.train.checkpoint_every = 0  # 0 is never
 
+config.train.prefetch_batches = 0  # number of batches the (magnet / episode) sampler generates ahead in a thread, 0 is off
+
 config.train.for_bs = 64  # the batch size for forward pass for building clusters (magnet) or reps (repmet), lower if running out of mem
+config.train.for_workers = 1  # the number of data loading workers for the forward pass
+config.train.for_pin_memory = False  # load forward pass batches into pinned memory for asynchronous copies to the gpu
+config.train.for_prefetch_factor = 2  # the number of batches each worker loads ahead in the forward pass
+config.train.for_amp = False  # run the forward pass in mixed precision
+config.train.for_channels_last = False  # run the forward pass with the inputs in the channels last memory format, converts the model to it
+config.train.bank_dtype = 'float32'  # storage type of the embedding bank of the train set, float16 halves the memory
+config.train.bank_memmap = False  # memory-map the embedding bank to a file in the run directory rather than keep in RAM
 
 config.train.epochs = None
 
@@ -86,9 +101,13 @@ config.train.query_per_epi = ''
 config.train.k = ''
 config.train.m = ''
 config.train.d = ''
+# magnet
+config.train.cluster_update = 'full'  # 'full' re-embeds the train set every 10 steps, 'minibatch' updates from batches
+config.train.full_cluster_update_every = 1  # epochs between full re-embeds in 'minibatch' cluster update mode
 # repmet
 config.train.alpha = ''
 config.train.sigma = ''
+config.train.soft_acc = True  # False skips the soft probabilities in training, acc is then from the closest rep
 
 # detection
 config.train.scales = (600,)  # Scale to use during testing (can list multiple scales) The scale is the pixel size of an image's shortest side
@@ -96,6 +115,11 @@ config.train.max_size = 1000  # Max pixel size of the longest side of a scaled i
 
 
 config.train.img_per_batch = 1  # Images to use per minibatch
+config.train.workers = 4  # the number of data loading workers of the detection loader
+config.train.pin_memory = True  # load batches into pinned memory for asynchronous copies to the gpu
+config.train.persistent_workers = True  # keep the loader workers alive between epochs rather than restarting them
+config.train.prefetch_factor = 2  # the number of batches each worker loads ahead
+config.train.device_prefetch = True  # copy the next batch to the gpu on a side stream while the current step runs
 config.train.batch_size = 128  # Minibatch size (number of regions of interest [ROIs])
 
 config.train.use_all_gt = True  # For COCO, setting USE_ALL_GT to False will exclude boxes that are flagged as ''iscrowd''
@@ -140,6 +164,12 @@ config.val.every = 0  # 0 is never
 
 config.val.sampler = None
 config.val.loss = None
+config.val.batch_size = 64  # the batch size when there is no batch sampler for the split (eg. magnet evaluation)
+config.val.workers = 4  # the number of data loading workers of the detection loader
+config.val.pin_memory = True  # load batches into pinned memory for asynchronous copies to the gpu
+config.val.persistent_workers = True  # keep the loader workers alive between validations rather than restarting them
+config.val.prefetch_factor = 2  # the number of batches each worker loads ahead
+config.val.device_prefetch = True  # copy the next batch to the gpu on a side stream while the current step runs
 
 config.val.episodes = ''
 
@@ -162,6 +192,7 @@ config.vis = edict()
 config.vis.every = 0  # 0 is never
 config.vis.plot_embed_every = 0  # 0 is never
 config.vis.test_plot_embed_every = 0  # 0 is never
+config.vis.plot_bank = False  # plot the embedding bank of the whole train set rather than the batch (magnet + repmet)
 
 # config.train.dml = False  # Use embedding networks? Baselines are false  # TODO does this go in model config?
 
@@ -174,6 +205,7 @@ config.test.resume_from = 'B'  # B is best, L is latest, or define own path
 
 config.test.sampler = None
 config.test.loss = None
+config.test.batch_size = 64  # the batch size when there is no batch sampler for the split (eg. magnet evaluation)
 
 config.test.episodes = ''
 
@@ -0,0 +1,89 @@
+"""
+Micro-benchmarks of the detection data loading.
+
+getitem: DetectionWrapper.__getitem__ latency across dataset sizes on a synthetic dataset (so no images need to be
+downloaded), along with the cost of the aspect ratio lookup alone, the old list(ratio_index).index(index) scan against
+the precomputed sample_ratios.
+
+python -m data_loading.benchmark getitem --sizes 1000 5000 33000
+"""
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from data_loading.detection_wrapper import DetectionWrapper
+
+
+class SyntheticDetectionDataset(object):
+    """A stand in for PascalVOCDataset with random sized blank images and random boxes"""
+
+    def __init__(self, n_samples, n_categories=21, max_num_box=5, seed=0):
+        rng = np.random.RandomState(seed)
+
+        self.n_categories = n_categories
+        self.sample_ids = ['{:06d}'.format(i) for i in range(n_samples)]
+        self.data = {}
+        for sample_id in self.sample_ids:
+            width, height = rng.randint(200, 500, size=2)
+            n_boxes = rng.randint(1, max_num_box + 1)
+            x1, y1 = rng.randint(0, width // 2, size=n_boxes), rng.randint(0, height // 2, size=n_boxes)
+            boxes = np.stack([x1, y1, x1 + width // 3, y1 + height // 3], 1).astype(np.uint16)
+            gt_classes = rng.randint(1, n_categories, size=n_boxes).astype(np.int32)
+            overlaps = np.zeros((n_boxes, n_categories), dtype=np.float32)
+            overlaps[np.arange(n_boxes), gt_classes] = 1.0
+            self.data[sample_id] = {'width': int(width), 'height': int(height), 'boxes': boxes,
+                                    'gt_classes': gt_classes, 'gt_overlaps': overlaps}
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    def __getitem__(self, index):
+        y = self.data[self.sample_ids[index]]
+        return Image.new('RGB', (y['width'], y['height'])), y
+
+    def get_img_path(self, sample_id):
+        return sample_id
+
+
+def time_per_call(fn, indexes):
+    since = time.time()
+    for index in indexes:
+        fn(index)
+    return (time.time() - since) / len(indexes) * 1000
+
+
+def benchmark_getitem(sizes, n_calls, batch_size):
+    print('{:>8s} {:>18s} {:>18s} {:>14s}'.format('size', 'scan lookup ms', 'array lookup ms', 'getitem ms'))
+    for size in sizes:
+        wrapper = DetectionWrapper(SyntheticDetectionDataset(size), batch_size=batch_size, training=True)
+        indexes = np.random.randint(0, size, size=n_calls)
+
+        def scan_lookup(index):
+            index = int(wrapper.ratio_index[index])
+            return wrapper.ratio_list[list(wrapper.ratio_index).index(index)]
+
+        def array_lookup(index):
+            return wrapper.sample_ratios[int(wrapper.ratio_index[index])]
+
+        print('{:8d} {:18.4f} {:18.4f} {:14.4f}'.format(size,
+                                                       time_per_call(scan_lookup, indexes),
+                                                       time_per_call(array_lookup, indexes),
+                                                       time_per_call(wrapper.__getitem__, indexes)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the detection data loading')
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    getitem_parser = subparsers.add_parser('getitem', help='DetectionWrapper.__getitem__ latency')
+    getitem_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 33000])
+    getitem_parser.add_argument('--n_calls', type=int, default=200)
+    getitem_parser.add_argument('--batch_size', type=int, default=1)
+
+    args = parser.parse_args()
+    if args.benchmark == 'getitem':
+        benchmark_getitem(args.sizes, args.n_calls, args.batch_size)
+    else:
+        parser.print_help()
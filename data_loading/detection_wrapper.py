@@ -29,7 +29,8 @@ class DetectionWrapper(Dataset):
                  scales=(600,),
                  max_size=1000,
                  use_all_gt=True,
-                 training=True):
+                 training=True,
+                 image_cache=None):
 
         super(DetectionWrapper, self).__init__()
 
@@ -41,6 +42,7 @@ class DetectionWrapper(Dataset):
         self.max_size = max_size
         self.use_all_gt = use_all_gt
         self.training = training
+        self.image_cache = image_cache  # an ImageCache of pre-resized images, if None images are decoded each sample
 
         # Set this data to that of the wrapped dataset
 
@@ -54,23 +56,33 @@ class DetectionWrapper(Dataset):
         # given the ratio_list, we want to make the ratio same for each batch.
         self.ratio_list, self.ratio_index = self.rank_data_ratio()
 
+        # the target ratio of each sample by its dataset index (the inverse of ratio_index), for O(1) lookup
+        self.sample_ratios = torch.empty_like(self.ratio_list)
+        self.sample_ratios[torch.from_numpy(self.ratio_index)] = self.ratio_list
+
     def __getitem__(self, index):
 
         # Change index to be that of particular ratio'd image
         if self.training:
             index = int(self.ratio_index[index])
 
-        # Get the sample from the inner dataset
-        img, y = self.dataset[index]
+        if self.image_cache is None:
+            # Get the sample from the inner dataset
+            img, y = self.dataset[index]
 
-        # Form the gt_boxes array
-        gt_boxes = self.form_gt_boxes(y)
+            # Form the gt_boxes array
+            gt_boxes = self.form_gt_boxes(y)
 
-        # Scale the img and gt_boxes with the scales in self.scales
-        img, gt_boxes, im_scale = self.scale(img, gt_boxes)
+            # Scale the img and gt_boxes with the scales in self.scales
+            img, gt_boxes, im_scale = self.scale(img, gt_boxes)
 
-        # Convert from PIL img to tensor
-        img = trns.ToTensor()(img)  #  -> torch.FloatTensor (C x H x W) [0.0, 1.0]
+            # Convert from PIL img to tensor
+            img = trns.ToTensor()(img)  #  -> torch.FloatTensor (C x H x W) [0.0, 1.0]
+        else:
+            # Get the annotations only, the img is already scaled in the cache
+            y = self.data[self.sample_ids[index]]
+            gt_boxes = self.form_gt_boxes(y)
+            img, gt_boxes, im_scale = self.load_cached(index, y, gt_boxes)
 
         # Make im_info tensor
         im_info = torch.from_numpy(np.array([img.shape[1], img.shape[2], im_scale], dtype=np.float32))
@@ -81,10 +93,10 @@ class DetectionWrapper(Dataset):
             gt_boxes = torch.from_numpy(gt_boxes)
 
             # if the image need to crop, crop to the target size.
-            ratio = self.ratio_list[list(self.ratio_index).index(index)]  # todo index is not correct, should be 0
+            ratio = self.sample_ratios[index]
 
             # Crop samples if their aspect ratio is too great
-            if y['need_crop']:
+            if self.need_crop[index]:
                 img, gt_boxes = self.crop(ratio, img, gt_boxes)
 
             # Pad samples so they enter the network with same size
@@ -106,7 +118,7 @@ class DetectionWrapper(Dataset):
             return img, im_info, gt_boxes, num_boxes
 
     def __len__(self):
-        return len(self.data)
+        return len(self.sample_ids)
 
     def form_gt_boxes(self, y):
         """
@@ -123,7 +135,7 @@ class DetectionWrapper(Dataset):
             gt_inds = np.where(y['gt_classes'] != 0)[0]
         else:
             # For the COCO ground truth boxes, exclude the ones that are ''iscrowd''
-            gt_inds = np.where((y['gt_classes'] != 0) & np.all(y['gt_overlaps'].toarray() > -1.0, axis=1))[0]
+            gt_inds = np.where((y['gt_classes'] != 0) & np.all(y['gt_overlaps'] > -1.0, axis=1))[0]
 
         gt_boxes = np.empty((len(gt_inds), 5), dtype=np.float32)
         gt_boxes[:, 0:4] = y['boxes'][gt_inds]
@@ -162,6 +174,31 @@ class DetectionWrapper(Dataset):
 
         return img, gt_boxes, im_scale
 
+    def load_cached(self, index, y, gt_boxes):
+        """
+        Load an image from the image cache at a random scale of self.scales, as scale() would resize it to
+
+        :param index: the index of the sample in the inner dataset
+        :param y: the sample's dictionary
+        :param gt_boxes: the numpy gt_boxes to scale
+        :return: the scaled img tensor (C x H x W) [0.0, 1.0] and numpy gt_boxes, plus the im_scale that we using
+        """
+        # Sample random scales from self.scales
+        random_scale_inds = npr.randint(0, high=len(self.scales), size=1)
+        target_size = self.scales[random_scale_inds[0]]
+        im_scale = float(target_size) / float(min(y['width'], y['height']))
+
+        # Slice the (H x W x C uint8) img from the shard, flipped samples share the unflipped img
+        img = torch.from_numpy(self.image_cache.get(self.dataset.get_img_path(self.sample_ids[index]), target_size))
+        if y['flipped']:
+            img = img.flip(1)
+        img = img.permute(2, 0, 1).float().div_(255)
+
+        # Scale the (NUMPY) gt_boxes
+        gt_boxes[:, 0:4] = gt_boxes[:, 0:4] * im_scale
+
+        return img, gt_boxes, im_scale
+
     def crop(self, ratio, img, gt_boxes):
         """
         Crops an image and it's gt_boxes if the aspect ratio is too great
@@ -316,25 +353,18 @@ class DetectionWrapper(Dataset):
         ratio_large = 2  # largest ratio to preserve.
         ratio_small = 0.5  # smallest ratio to preserve.
 
-        # calculate, clip and store the ratios, add flag if imgs need crop
-        ratio_list = []
-        for sample_id in self.sample_ids:
-            width = self.data[sample_id]['width']
-            height = self.data[sample_id]['height']
-            ratio = width / float(height)
-
-            if ratio > ratio_large:
-                self.data[sample_id]['need_crop'] = 1
-                ratio = ratio_large
-            elif ratio < ratio_small:
-                self.data[sample_id]['need_crop'] = 1
-                ratio = ratio_small
-            else:
-                self.data[sample_id]['need_crop'] = 0
-
-            ratio_list.append(ratio)
+        # calculate, clip and store the ratios, flag the imgs that need crop (by dataset index, the sample dicts may
+        # be made on access so aren't written to)
+        annotations = getattr(self.dataset, 'annotations', None)
+        if annotations is not None and len(annotations) == len(self.sample_ids):
+            widths, heights = annotations.widths, annotations.heights
+        else:
+            widths = np.array([self.data[sample_id]['width'] for sample_id in self.sample_ids])
+            heights = np.array([self.data[sample_id]['height'] for sample_id in self.sample_ids])
+        ratio_list = widths / heights.astype(float)
 
-        ratio_list = np.array(ratio_list)
+        self.need_crop = (ratio_list > ratio_large) | (ratio_list < ratio_small)
+        ratio_list = np.clip(ratio_list, ratio_small, ratio_large)
         ratio_index = np.argsort(ratio_list)  # sort
 
         ratio_list = ratio_list[ratio_index]  # rearrange sample indexs in the ratio smallest to largest order
@@ -362,27 +392,20 @@ class DetectionWrapper(Dataset):
         return ratio_list, ratio_index
 
     def prepare_dataset(self):
-        """Enrich the dataset's roidb by adding some derived quantities that
-        are useful for training. This function precomputes the maximum
-        overlap, taken over ground-truth boxes, between each ROI and
-        each ground-truth box. The class with maximum overlap is also
-        recorded.
+        """Sanity check the dataset's roidb: the class with the maximum overlap of each ground-truth box is background
+        exactly when that overlap is 0. (The per sample max_overlaps / max_classes aren't stored, nothing reads them
+        and the sample dicts may be made on access)
         """
-        # todo check whether these actually helpful
-        for sample_id in self.data.keys():
-            self.data[sample_id]['img_id'] = sample_id
-            self.data[sample_id]['image'] = self.dataset.get_img_path(sample_id)
-
-            # need gt_overlaps as a dense array for argmax
-            gt_overlaps = self.data[sample_id]['gt_overlaps'].toarray()
+        annotations = getattr(self.dataset, 'annotations', None)
+        if annotations is not None:
+            overlaps = [annotations.gt_overlaps]
+        else:
+            overlaps = [self.data[sample_id]['gt_overlaps'] for sample_id in self.sample_ids]
 
-            # max overlap with gt over classes (columns)
+        for gt_overlaps in overlaps:
+            # max overlap with gt over classes (columns), and the gt class that had the max overlap
             max_overlaps = gt_overlaps.max(axis=1)
-
-            # gt class that had the max overlap
             max_classes = gt_overlaps.argmax(axis=1)
-            self.data[sample_id]['max_classes'] = max_classes
-            self.data[sample_id]['max_overlaps'] = max_overlaps
 
             # sanity checks
             # max overlap of 0 => class should be zero (background)
@@ -0,0 +1,60 @@
+"""
+DevicePrefetcher: wraps a DataLoader and copies the next batch to the gpu on a side CUDA stream while the current
+training step runs.
+
+With a pin_memory loader the host to device copies are asynchronous, so by the time a batch is yielded its tensors
+are (usually) already on the gpu, and the compute stream only waits on the copy of that one batch. Off the gpu the
+batches are moved with a plain .to(device).
+"""
+import torch
+
+
+class DevicePrefetcher(object):
+
+    def __init__(self, loader, device, enabled=True):
+        """
+        :param loader: the DataLoader to prefetch from, yielding tuples / lists of tensors
+        :param device: the device to move the batches to
+        :param enabled: (boolean) use the side stream, if False (or not on cuda) each batch is moved when it's yielded
+        """
+
+        super(DevicePrefetcher, self).__init__()
+
+        # set instance variables
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if enabled and device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def to_device(self, batch):
+        return [t.to(self.device, non_blocking=True) if torch.is_tensor(t) else t for t in batch]
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield self.to_device(batch)
+            return
+
+        loader = iter(self.loader)
+        staged = self.stage(loader)
+        while staged is not None:
+            # wait for this batch's copy only, and mark its tensors as used by the compute stream so their memory
+            # isn't handed back to the side stream's allocations while the step still reads them
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            for t in staged:
+                if torch.is_tensor(t):
+                    t.record_stream(torch.cuda.current_stream(self.device))
+
+            batch, staged = staged, self.stage(loader)
+            yield batch
+
+    def stage(self, loader):
+        """Start copying the next batch of the loader to the device on the side stream, None when exhausted"""
+        try:
+            batch = next(loader)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
@@ -0,0 +1,143 @@
+"""
+ImageCache: images decoded and resized ahead of time into packed uint8 shards, memory-mapped at training time.
+
+The prepare step (prepare_image_cache, or run this file) resizes every image of a detection set to each of the
+config.train.scales shortest side sizes, the same way DetectionWrapper.scale does, and appends the raw (H x W x 3)
+uint8 pixels to one shard file per scale, with an index of each image's offset and shape. A DetectionWrapper given
+the cache then slices its images straight out of the memory-mapped shards instead of opening, decoding and
+resizing the JPEG every sample.
+
+Flipped samples ('_f' ids) share the shard entry of their image and are flipped when loaded.
+
+python -m data_loading.image_cache --cfg detection/experiments/FRCNN_standard_res101_voc.yaml
+"""
+import os
+import argparse
+
+import numpy as np
+from torchvision import transforms as trns
+
+
+class ImageCache(object):
+
+    def __init__(self, cache_dir, scales):
+        """
+        :param cache_dir: the directory of the shards and their indexes
+        :param scales: the shortest side sizes the images are cached at
+        """
+        super(ImageCache, self).__init__()
+
+        self.cache_dir = cache_dir
+        self.scales = scales
+
+        # loaded on first use, so each DataLoader worker maps the shards itself
+        self.index = None
+        self.shards = {}
+
+    def shard_path(self, scale):
+        return os.path.join(self.cache_dir, '{}.u8'.format(scale))
+
+    def index_path(self, scale):
+        return os.path.join(self.cache_dir, '{}_index.npz'.format(scale))
+
+    def load_index(self, scale):
+        """
+        :return: dict of image path > (offset, (height, width, channels)) of a scale's shard, empty if not prepared
+        """
+        if not os.path.exists(self.index_path(scale)):
+            return {}
+        index = np.load(self.index_path(scale))
+        return {path: (offset, tuple(shape)) for path, offset, shape in zip(index['paths'].tolist(),
+                                                                            index['offsets'].tolist(),
+                                                                            index['shapes'].tolist())}
+
+    def get(self, img_path, scale):
+        """
+        The cached image, a view into the memory-mapped shard (copy on write, so the shard is never modified)
+
+        :param img_path: the path of the original image
+        :param scale: the shortest side size
+        :return: (H x W x 3) uint8 array
+        """
+        if self.index is None:
+            self.index = {s: self.load_index(s) for s in self.scales}
+        if img_path not in self.index[scale]:
+            raise KeyError("{} isn't in the image cache at scale {}, run the prepare step "
+                           "(python -m data_loading.image_cache)".format(img_path, scale))
+
+        if scale not in self.shards:
+            self.shards[scale] = np.memmap(self.shard_path(scale), dtype=np.uint8, mode='c')
+
+        offset, shape = self.index[scale][img_path]
+        return self.shards[scale][offset:offset + int(np.prod(shape))].reshape(shape)
+
+
+def resize_shortest_side(img, target_size):
+    """Resize a PIL image so its shortest side is target_size, as DetectionWrapper.scale"""
+    w, h = img.size
+    im_scale = float(target_size) / float(min(w, h))
+    return trns.Resize((int(np.round(h * im_scale)), int(np.round(w * im_scale))))(img)
+
+
+def prepare_image_cache(dataset, cache_dir, scales):
+    """
+    Write the images of a dataset into the cache shards, images already cached are skipped so multiple sets (eg.
+    train and val) can share a cache
+
+    :param dataset: a detection set (eg. PascalVOCDataset, CombinedDataset) with sample_ids, data and get_img_path
+    :param cache_dir: the directory of the shards and their indexes
+    :param scales: the shortest side sizes to cache the images at
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cache = ImageCache(cache_dir, scales)
+
+    for scale in scales:
+        index = cache.load_index(scale)
+        offset = os.path.getsize(cache.shard_path(scale)) if os.path.exists(cache.shard_path(scale)) else 0
+
+        n_added = 0
+        with open(cache.shard_path(scale), 'ab') as shard:
+            for index_, sample_id in enumerate(dataset.sample_ids):
+                img_path = dataset.get_img_path(sample_id)
+                if img_path in index or dataset.data[sample_id]['flipped']:
+                    continue  # flipped samples use the unflipped image
+
+                img, _ = dataset[index_]
+                img = np.asarray(resize_shortest_side(img, scale), dtype=np.uint8)
+
+                shard.write(img.tobytes())
+                index[img_path] = (offset, img.shape)
+                offset += img.nbytes
+                n_added += 1
+
+        paths = list(index.keys())
+        np.savez(cache.index_path(scale),
+                 paths=np.array(paths),
+                 offsets=np.array([index[p][0] for p in paths], dtype=np.int64),
+                 shapes=np.array([index[p][1] for p in paths], dtype=np.int64).reshape(-1, 3))
+        print('Cached {} new images at scale {} in {} ({:.1f} GB)'.format(n_added, scale, cache_dir, offset / 1e9))
+
+
+if __name__ == "__main__":
+    from utils.debug import set_working_dir
+    from config.config import config, update_config
+    from data_loading.initialize import initialize_dataset
+
+    parser = argparse.ArgumentParser(description='Prepare the detection image cache')
+    parser.add_argument('--cfg', help='experiment configure file name', required=True, type=str)
+    args, rest = parser.parse_known_args()
+
+    # set the working directory as appropriate
+    set_working_dir()
+    update_config(args.cfg)
+    assert config.dataset.image_cache, "set config.dataset.image_cache to the directory to write the cache to"
+
+    for split in ['train', 'val']:
+        detection_set = initialize_dataset(config=config,
+                                           dataset_name=config.dataset.name,
+                                           dataset_id=config.dataset.id,
+                                           split=split,
+                                           input_size=None,
+                                           mean=None,
+                                           std=None)
+        prepare_image_cache(detection_set.dataset, config.dataset.image_cache, config.train.scales)
@@ -1,9 +1,11 @@
+import torch
 from torchvision import transforms as trns
 from torchvision.datasets import MNIST
 
 from data_loading.samplers import EpisodeBatchSampler, MagnetBatchSampler, DetectionSampler
 from data_loading.sets import OmniglotDataset, OxfordFlowersDataset, OxfordPetsDataset, StanfordDogsDataset, PascalVOCDataset, CombinedDataset
 from data_loading.detection_wrapper import DetectionWrapper
+from data_loading.image_cache import ImageCache
 
 def initialize_dataset(config, dataset_name, dataset_id, split, input_size, mean, std):
 
@@ -91,6 +93,7 @@ def initialize_dataset(config, dataset_name, dataset_id, split, input_size, mean
                                                  scales=config.train.scales,
                                                  max_size=config.train.max_size,
                                                  use_all_gt=config.train.use_all_gt,
+                                                 image_cache=initialize_image_cache(config),
                                                  training=True)
 
                 return detection_set
@@ -111,6 +114,7 @@ def initialize_dataset(config, dataset_name, dataset_id, split, input_size, mean
                                                  scales=config.train.scales,
                                                  max_size=config.train.max_size,
                                                  use_all_gt=config.train.use_all_gt,
+                                                 image_cache=initialize_image_cache(config),
                                                  training=True)#False)
 
                 return detection_set
@@ -144,6 +148,7 @@ def initialize_dataset(config, dataset_name, dataset_id, split, input_size, mean
                                                  scales=config.train.scales,
                                                  max_size=config.train.max_size,
                                                  use_all_gt=config.train.use_all_gt,
+                                                 image_cache=initialize_image_cache(config),
                                                  training=True)
 
                 return detection_set
@@ -163,6 +168,7 @@ def initialize_dataset(config, dataset_name, dataset_id, split, input_size, mean
                                                  scales=config.train.scales,
                                                  max_size=config.train.max_size,
                                                  use_all_gt=config.train.use_all_gt,
+                                                 image_cache=initialize_image_cache(config),
                                                  training=True)  # False)
 
                 return detection_set
@@ -174,6 +180,22 @@ def initialize_dataset(config, dataset_name, dataset_id, split, input_size, mean
         raise ValueError("Dataset '%s' not recognised." % dataset_name)
 
 
+def initialize_image_cache(config):
+    if config.dataset.image_cache:
+        return ImageCache(cache_dir=config.dataset.image_cache, scales=config.train.scales)
+    return None
+
+
+def initialize_loader_options(config, split):
+    """The DataLoader options of a split, (config.train or config.val)"""
+    split_config = config.train if split == 'train' else config.val
+    workers = split_config.workers
+    return {'num_workers': workers,
+            'pin_memory': split_config.pin_memory and torch.cuda.is_available(),
+            'persistent_workers': split_config.persistent_workers and workers > 0,
+            'prefetch_factor': split_config.prefetch_factor if workers > 0 else None}
+
+
 def initialize_sampler(config, sampler_name, dataset, split):
 
     if sampler_name == 'episodes':
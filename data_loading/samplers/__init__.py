@@ -1,4 +1,5 @@
 # This allows us to import the samplers without having to refer to their python file
 from data_loading.samplers.episode_batch import EpisodeBatchSampler
 from data_loading.samplers.magnet_batch import MagnetBatchSampler
-from data_loading.samplers.detection_batch import DetectionSampler
\ No newline at end of file
+from data_loading.samplers.detection_batch import DetectionSampler
+from data_loading.samplers.prefetch_batch import PrefetchBatchSampler
\ No newline at end of file
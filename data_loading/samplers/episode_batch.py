@@ -26,43 +26,42 @@ class EpisodeBatchSampler(object):
         self.sample_per_class = num_samples
         self.episodes = episodes
 
-        self.classes, self.counts = np.unique(self.labels, return_counts=True)
+        labels = np.asarray(self.labels)
+        self.classes, label_idxs, self.counts = np.unique(labels, return_inverse=True, return_counts=True)
         self.classes = torch.LongTensor(self.classes)
 
-        # create a matrix of sample indexes with dim: (num_classes, max(numel_per_lass))
-        # fill it with nans
-        self.idxs = range(len(self.labels))
-        self.indexes = np.empty((len(self.classes), max(self.counts)), dtype=int) * np.nan
-        self.indexes = torch.Tensor(self.indexes)
-        self.numel_per_class = torch.zeros_like(self.classes)
-
-        for idx, label in enumerate(self.labels):
-            # for every class c, fill the relative row with the indices samples belonging to c
-            label_idx = np.argwhere(self.classes == label).item()
-            self.indexes[label_idx, np.where(np.isnan(self.indexes[label_idx]))[0][0]] = idx
-
-            # in numel_per_class we store the number of samples for each class/row
-            self.numel_per_class[label_idx] += 1
+        # store the sample indexes sorted by class (CSR style), the samples of class row c are
+        # indexes[offsets[c]:offsets[c] + numel_per_class[c]]
+        self.indexes = torch.from_numpy(np.argsort(label_idxs.reshape(-1), kind='stable').astype(np.int64))
+        self.numel_per_class = torch.from_numpy(self.counts.astype(np.int64))
+        self.offsets = torch.cumsum(self.numel_per_class, 0) - self.numel_per_class
 
     def __iter__(self):
         """
         yield a batch of indexes
         """
+        for it in range(self.episodes):
+            yield self.gen_batch()
+
+    def gen_batch(self):
+        """
+        Sample the indexes of one episode
+        """
         spc = self.sample_per_class
         cpi = self.categories_per_epi
 
-        for it in range(self.episodes):
-            batch_size = spc * cpi
-            batch = torch.LongTensor(batch_size)
-            c_idxs = torch.randperm(len(self.classes))[:cpi]
-            for i, c in enumerate(self.classes[c_idxs]):
-                s = slice(i * spc, (i + 1) * spc)
-                # FIXME when torch.argwhere will exists
-                label_idx = torch.arange(len(self.classes)).long()[self.classes == c].item()
-                sample_idxs = torch.randperm(self.numel_per_class[label_idx])[:spc]
-                batch[s] = self.indexes[label_idx][sample_idxs]
-            batch = batch[torch.randperm(len(batch))]
-            yield batch
+        c_idxs = torch.randperm(len(self.classes))[:cpi]
+        numel = self.numel_per_class[c_idxs]
+
+        # take the first spc of a random ordering of the positions within each class, classes with fewer than spc
+        # samples repeat some
+        keys = torch.rand(len(c_idxs), max(int(numel.max()), spc))
+        keys[torch.arange(keys.size(1)).unsqueeze(0) >= numel.unsqueeze(1)] = 2  # rand is < 1 so these go last
+        positions = torch.argsort(keys, dim=1)[:, :spc] % numel.unsqueeze(1)
+
+        batch = self.indexes[(self.offsets[c_idxs].unsqueeze(1) + positions).view(-1)]
+        batch = batch[torch.randperm(len(batch))]
+        return batch
 
     def __len__(self):
         return self.episodes
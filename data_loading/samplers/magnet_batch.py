@@ -5,7 +5,8 @@ Modified from
 """
 import numpy as np
 import torch
-from sklearn.cluster import KMeans
+
+from utils.kmeans import batched_kmeans
 
 
 class MagnetBatchSampler(object):
@@ -37,12 +38,26 @@ class MagnetBatchSampler(object):
         self.centroids = None
         self.assignments = np.zeros_like(labels, int)
 
-        self.cluster_assignments = {}
+        # the number of examples each centroid has seen, used by the mini-batch cluster updates between full updates
+        self.centroid_counts = None
+        self.cluster_sizes = None
+
+        # the examples of each cluster in a compressed form, the examples of cluster c are
+        # cluster_order[cluster_offsets[c]:cluster_offsets[c+1]], and example i is at cluster_order[order_positions[i]]
+        self.cluster_order = None
+        self.cluster_offsets = None
+        self.order_positions = None
+        # the m-1 closest clusters of a different class to each cluster, precomputed whenever the centroids change
+        self.impostors = None
         self.cluster_classes = np.repeat(range(self.num_classes), k)
         self.example_losses = None
         self.cluster_losses = None
         self.has_loss = None
 
+        # running per cluster sums and counts of the measured example losses, so loss updates only touch the batch
+        self.cluster_loss_sums = None
+        self.cluster_loss_counts = None
+
         self.batch_indexes = None
 
     def __iter__(self):
@@ -60,58 +75,200 @@ class MagnetBatchSampler(object):
         """Given an array of representations for the entire training set,
         recompute clusters and store example cluster assignments in a
         quickly sampleable form."""
-        # Lazily allocate array for centroids
-        if self.centroids is None:
-            self.centroids = np.zeros([self.num_classes * self.k, rep_data.shape[1]])
-
-        for c in range(self.num_classes):
-            class_mask = self.labels == c
-            class_examples = rep_data[class_mask]
-            kmeans = KMeans(n_clusters=self.k, init='k-means++', n_init=1, max_iter=max_iter)
-            kmeans.fit(class_examples)
-
-            # Save cluster centroids for finding impostor clusters
-            start = self.get_cluster_ind(c, 0)
-            stop = self.get_cluster_ind(c, self.k)
-            self.centroids[start:stop] = kmeans.cluster_centers_
-
-            # Update assignments with new global cluster indexes
-            self.assignments[class_mask] = self.get_cluster_ind(c, kmeans.predict(class_examples))
-
-        # Construct a map from cluster to example indexes for fast batch creation
-        for cluster in range(self.k * self.num_classes):
-            cluster_mask = self.assignments == cluster
-            self.cluster_assignments[cluster] = np.flatnonzero(cluster_mask)
-
-    def update_losses(self, losses):
+        # Cluster all classes at once, warm starting from the previous centroids if we have them
+        self.centroids, self.assignments = batched_kmeans(rep_data, self.labels, self.num_classes, self.k,
+                                                          init_centroids=self.centroids, max_iter=max_iter)
+
+        # Construct a map from cluster to example indexes and the impostor clusters for fast batch creation
+        self.build_cluster_index()
+        self.centroid_counts = self.cluster_sizes.copy()
+        self.update_impostors()
+
+        # Assignments have changed so the running cluster loss sums and counts are no longer valid
+        if self.example_losses is not None:
+            self.rebuild_cluster_losses()
+
+    def update_clusters_minibatch(self, batch_reps, batch_indexes=None):
+        """Given the representations of the examples in the last batch, take a mini-batch k-means step on the
+        centroids of their classes, moving any examples which are now closer to another centroid of their class.
+        Much cheaper than re-embedding the entire training set.
+
+        batch_indexes default to those of the last generated batch, give them when batches are generated ahead."""
+        assert self.centroids is not None, "update_clusters() must be called before any mini-batch updates"
+
+        if batch_indexes is None:
+            batch_indexes = self.batch_indexes
+        batch_reps = np.asarray(batch_reps, dtype=np.float32)
+
+        # Assign each example to the closest centroid of its own class
+        batch_classes = self.labels[batch_indexes]
+        class_centroids = self.centroids.reshape(self.num_classes, self.k, -1)[batch_classes]
+        closest = ((batch_reps[:, np.newaxis] - class_centroids) ** 2).sum(axis=2).argmin(axis=1)
+        clusters = self.get_cluster_ind(batch_classes, closest)
+
+        # Move the centroids towards their batch means with a per centroid learning rate of 1 / examples seen
+        n_clusters = self.k * self.num_classes
+        batch_counts = np.bincount(clusters, minlength=n_clusters)
+        batch_sums = np.zeros_like(self.centroids)
+        np.add.at(batch_sums, clusters, batch_reps)
+        self.centroid_counts += batch_counts
+        touched = batch_counts > 0
+        self.centroids[touched] += (batch_sums[touched] - batch_counts[touched, np.newaxis] * self.centroids[touched]) \
+            / self.centroid_counts[touched, np.newaxis]
+
+        emptied = self.reassign(batch_indexes, clusters)
+
+        # The impostors of clusters that moved need recomputing, as do those of clusters with an emptied impostor.
+        # Other clusters keep their (slightly stale) impostors until the next full update
+        refresh = touched
+        if len(emptied):
+            refresh = refresh | np.isin(self.impostors, emptied).any(axis=1)
+        self.update_impostors(np.flatnonzero(refresh))
+
+    def build_cluster_index(self):
+        """Sort the examples by cluster so the examples of each cluster are a contiguous slice"""
+        self.cluster_sizes = np.bincount(self.assignments, minlength=self.k * self.num_classes)
+        self.cluster_order = np.argsort(self.assignments, kind='stable')
+        self.cluster_offsets = np.concatenate([[0], np.cumsum(self.cluster_sizes)])
+        self.order_positions = np.empty_like(self.cluster_order)
+        self.order_positions[self.cluster_order] = np.arange(len(self.cluster_order))
+
+    def move_example(self, index, old_cluster, cluster):
+        """Move an example between two clusters of its class in the cluster example map. The clusters of a class are
+        neighbouring slices of cluster_order, so the example is swapped across the boundaries between them, O(k)."""
+        order, offsets, positions = self.cluster_order, self.cluster_offsets, self.order_positions
+
+        def swap(a, b):
+            order[a], order[b] = order[b], order[a]
+            positions[order[a]], positions[order[b]] = a, b
+
+        if old_cluster < cluster:
+            # swap to the end of each cluster in turn and move that boundary back over it
+            for c in range(old_cluster, cluster):
+                swap(positions[index], offsets[c + 1] - 1)
+                offsets[c + 1] -= 1
+        else:
+            # swap to the start of each cluster in turn and move that boundary forward over it
+            for c in range(old_cluster, cluster, -1):
+                swap(positions[index], offsets[c])
+                offsets[c] += 1
+
+        self.cluster_sizes[old_cluster] -= 1
+        self.cluster_sizes[cluster] += 1
+
+    def update_impostors(self, clusters=None, chunk_size=1024):
+        """Precompute the m-1 closest (non empty) clusters of a different class for the given clusters (or all), -1 where
+        there are too few"""
+        n_clusters = self.k * self.num_classes
+        if clusters is None or self.impostors is None:
+            clusters = np.arange(n_clusters)
+            self.impostors = np.zeros([n_clusters, self.m - 1], int)
+
+        sq_norms = (self.centroids ** 2).sum(axis=1)
+        empty = self.cluster_sizes == 0
+
+        # do the rows in chunks so we never hold the full (n_clusters x n_clusters) distances
+        for start in range(0, len(clusters), chunk_size):
+            rows = clusters[start:start + chunk_size]
+            sq_dists = sq_norms[rows, np.newaxis] + sq_norms - 2 * np.dot(self.centroids[rows], self.centroids.T)
+
+            # Assure only (non empty) clusters of different class are chosen
+            sq_dists[self.cluster_classes[rows, np.newaxis] == self.cluster_classes] = np.inf
+            sq_dists[:, empty] = np.inf
+
+            impostors = np.argpartition(sq_dists, self.m - 1, axis=1)[:, :self.m - 1]
+            # -1 where there aren't m-1 non empty clusters of other classes
+            impostors[np.isinf(np.take_along_axis(sq_dists, impostors, axis=1))] = -1
+            self.impostors[rows] = impostors
+
+    def reassign(self, indexes, clusters):
+        """Move examples to new clusters, keeping the cluster example map and the running cluster losses in sync.
+        Only the moved examples are touched. Returns the clusters which lost all of their examples."""
+        indexes, unique = np.unique(indexes, return_index=True)
+        clusters = clusters[unique]
+
+        old_clusters = self.assignments[indexes]
+        moved = old_clusters != clusters
+        if not np.any(moved):
+            return np.zeros(0, int)
+
+        indexes, old_clusters, clusters = indexes[moved], old_clusters[moved], clusters[moved]
+        self.assignments[indexes] = clusters
+
+        n_clusters = self.k * self.num_classes
+        was_empty = self.cluster_sizes == 0
+        for index, old_cluster, cluster in zip(indexes.tolist(), old_clusters.tolist(), clusters.tolist()):
+            self.move_example(index, old_cluster, cluster)
+
+        if self.example_losses is not None:
+            had_loss = self.has_loss[indexes]
+            moved_losses = self.example_losses[indexes][had_loss]
+            self.cluster_loss_sums += np.bincount(clusters[had_loss], weights=moved_losses, minlength=n_clusters) \
+                - np.bincount(old_clusters[had_loss], weights=moved_losses, minlength=n_clusters)
+            self.cluster_loss_counts += np.bincount(clusters[had_loss], minlength=n_clusters) \
+                - np.bincount(old_clusters[had_loss], minlength=n_clusters)
+            self.set_cluster_losses(np.union1d(old_clusters, clusters))
+
+        return np.flatnonzero((self.cluster_sizes == 0) & ~was_empty)
+
+    def update_losses(self, losses, batch_indexes=None):
         """Given a list of examples indexes and corresponding losses
-        store the new losses and update corresponding cluster losses."""
+        store the new losses and update corresponding cluster losses.
+
+        Only the examples in the last batch are touched, the cluster losses are kept as running sums and counts
+        which are rebuilt over the whole set only when the cluster assignments change. batch_indexes default to
+        those of the last generated batch, give them when batches are generated ahead."""
         # Lazily allocate structures for losses
         if self.example_losses is None:
             self.example_losses = np.zeros_like(self.labels, float)
             self.cluster_losses = np.zeros([self.k * self.num_classes], float)
             self.has_loss = np.zeros_like(self.labels, bool)
+            self.cluster_loss_sums = np.zeros([self.k * self.num_classes], float)
+            self.cluster_loss_counts = np.zeros([self.k * self.num_classes], int)
 
         losses = losses.data.cpu().numpy()
 
-        self.example_losses[self.batch_indexes] = losses
-        self.has_loss[self.batch_indexes] = losses
+        # a batch can hold an example more than once if its cluster had fewer than d examples
+        if batch_indexes is None:
+            batch_indexes = self.batch_indexes
+        batch_indexes, unique = np.unique(batch_indexes, return_index=True)
+        losses = losses[unique]
 
-        epsilon = 1e-8
+        n_clusters = self.k * self.num_classes
+        batch_clusters = self.assignments[batch_indexes]
 
-        # Find affected clusters and update the corresponding cluster losses
-        clusters = np.unique(self.assignments[self.batch_indexes])
-        for cluster in clusters:
-            cluster_inds = self.assignments == cluster
-            cluster_example_losses = self.example_losses[cluster_inds]
+        # Remove the old contributions of the batch examples that already had a loss measured
+        had_loss = self.has_loss[batch_indexes]
+        self.cluster_loss_sums -= np.bincount(batch_clusters[had_loss],
+                                              weights=self.example_losses[batch_indexes][had_loss],
+                                              minlength=n_clusters)
+        self.cluster_loss_counts -= np.bincount(batch_clusters[had_loss], minlength=n_clusters)
 
-            # Take the average closs in the cluster of examples for which we have measured a loss
-            inds = cluster_example_losses[self.has_loss[cluster_inds]]
+        self.example_losses[batch_indexes] = losses
+        self.has_loss[batch_indexes] = True
 
-            if len(inds) < 1:
-                self.cluster_losses[cluster] = epsilon
-            else:
-                self.cluster_losses[cluster] = np.mean(cluster_example_losses[self.has_loss[cluster_inds]]) + epsilon
+        # Add the new contributions
+        self.cluster_loss_sums += np.bincount(batch_clusters, weights=losses, minlength=n_clusters)
+        self.cluster_loss_counts += np.bincount(batch_clusters, minlength=n_clusters)
+
+        # Find affected clusters and update the corresponding cluster losses
+        self.set_cluster_losses(np.unique(batch_clusters))
+
+    def rebuild_cluster_losses(self):
+        """Recompute the running cluster loss sums and counts over the entire set, called when assignments change."""
+        n_clusters = self.k * self.num_classes
+        clusters = self.assignments[self.has_loss]
+        self.cluster_loss_sums = np.bincount(clusters, weights=self.example_losses[self.has_loss], minlength=n_clusters)
+        self.cluster_loss_counts = np.bincount(clusters, minlength=n_clusters)
+        self.set_cluster_losses(np.arange(n_clusters))
+
+    def set_cluster_losses(self, clusters):
+        """Take the average loss in each of the given clusters of examples for which we have measured a loss."""
+        epsilon = 1e-8
+
+        counts = self.cluster_loss_counts[clusters]
+        means = self.cluster_loss_sums[clusters] / np.maximum(counts, 1)
+        self.cluster_losses[clusters] = np.where(counts > 0, np.maximum(means, 0), 0) + epsilon
 
     def gen_batch(self):
         """Sample a batch by first sampling a seed cluster proportionally to
@@ -121,45 +278,55 @@ class MagnetBatchSampler(object):
         The generated batch will consist of m clusters each with d consecutive
         examples."""
 
-        # Sample seed cluster proportionally to cluster losses if available
-        if self.cluster_losses is not None:
-            p = self.cluster_losses / np.sum(self.cluster_losses)
-            seed_cluster = np.random.choice(self.num_classes * self.k, p=p)
-        else:
-            seed_cluster = np.random.choice(self.num_classes * self.k)
+        # Mini-batch cluster updates can empty clusters, these can't be sampled from
+        non_empty = self.cluster_sizes > 0
 
-        # Get imposter clusters by ranking centroids by distance
-        sq_dists = ((self.centroids[seed_cluster] - self.centroids) ** 2).sum(axis=1)
+        # Sample seed cluster proportionally to cluster losses if available, uniformly if none have any loss
+        p = self.cluster_losses * non_empty if self.cluster_losses is not None else None
+        if p is not None and np.sum(p) > 0:
+            seed_cluster = np.random.choice(self.num_classes * self.k, p=p / np.sum(p))
+        else:
+            seed_cluster = np.random.choice(np.flatnonzero(non_empty))
 
-        # Assure only clusters of different class from seed are chosen
-        sq_dists[self.get_class_ind(seed_cluster) == self.cluster_classes] = np.inf
+        # Get the precomputed impostor clusters, refreshing them if one has since emptied, and add seed
+        def valid(impostors):
+            return np.all(impostors >= 0) and np.all(non_empty[impostors])
 
-        # Get top impostor clusters and add seed
-        clusters = np.argpartition(sq_dists, self.m - 1)[:self.m - 1]
-        clusters = np.concatenate([[seed_cluster], clusters])
+        if not valid(self.impostors[seed_cluster]):
+            self.update_impostors(np.array([seed_cluster]))
+            if not valid(self.impostors[seed_cluster]):
+                raise ValueError("Fewer than m-1 (%d) non empty clusters of other classes to sample impostors from"
+                                 % (self.m - 1))
+        clusters = np.concatenate([[seed_cluster], self.impostors[seed_cluster]])
 
         # print(clusters)  # debug print the clusters per batch
 
-        # Sample examples uniformly from cluster
-        batch_indexes = np.empty([self.m * self.d], int)
-        for i, c in enumerate(clusters):
-            # TODO sometimes arent enough cluster assignments available, what do we do then?
-            # if you get this you can set k = 1 (one cluster per class)
-            x = np.random.choice(self.cluster_assignments[c], self.d, replace=False) # replace=False)  # sometimes there ain't enough d in assignments...
-            start = i * self.d
-            stop = start + self.d
-            batch_indexes[start:stop] = x
-
-        # Translate class indexes to index for classes within the batch
-        class_inds = np.array([self.get_class_ind(c) for c in clusters])
-        batch_class_inds = []
-        inds_map = {}
-        class_count = 0
-        for c in class_inds:
-            if c not in inds_map:
-                inds_map[c] = class_count
-                class_count += 1
-            batch_class_inds.append(inds_map[c])
+        # Sample examples uniformly from each cluster, all at once as positions within the clusters
+        sizes = self.cluster_sizes[clusters]
+        positions = (np.random.random_sample([self.m, self.d]) * sizes[:, np.newaxis]).astype(int)
+
+        # Small clusters take the first d of a random ordering of their positions, those with fewer than d examples
+        # (mini-batch cluster updates can leave fewer than d in a cluster) have to repeat some
+        small = sizes <= self.d * self.d
+        if np.any(small):
+            keys = np.random.random_sample([small.sum(), max(sizes[small].max(), self.d)])
+            keys[np.arange(keys.shape[1]) >= sizes[small, np.newaxis]] = np.inf
+            positions[small] = np.argsort(keys, axis=1)[:, :self.d] % sizes[small, np.newaxis]
+
+        # Large clusters rarely get an example twice, just redraw those that did
+        while True:
+            sorted_positions = np.sort(positions, axis=1)
+            redraw = np.any(sorted_positions[:, 1:] == sorted_positions[:, :-1], axis=1) & ~small
+            if not np.any(redraw):
+                break
+            positions[redraw] = (np.random.random_sample([redraw.sum(), self.d]) * sizes[redraw, np.newaxis]).astype(int)
+
+        batch_indexes = self.cluster_order[self.cluster_offsets[clusters, np.newaxis] + positions].reshape(-1)
+
+        # Translate class indexes to index for classes within the batch, in order of first appearance
+        class_inds = self.get_class_ind(clusters)
+        _, first, inverse = np.unique(class_inds, return_index=True, return_inverse=True)
+        batch_class_inds = np.argsort(np.argsort(first))[inverse]
 
         self.batch_indexes = batch_indexes  # this is used to update losses
 
@@ -172,7 +339,7 @@ class MagnetBatchSampler(object):
 
     def get_class_ind(self, c):
         """Given a cluster index return the class index."""
-        return int(c / self.k)  # int floors it for us nicely, without this you could get a floating value
+        return c // self.k  # floor divide, without this you could get a floating value (works on arrays too)
 
 
 # if __name__ == "__main__":
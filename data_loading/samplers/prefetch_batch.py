@@ -0,0 +1,101 @@
+"""
+PrefetchBatchSampler: wraps a batch sampler and generates its batches ahead of time in a background thread.
+
+The wrapped sampler needs a gen_batch() method (MagnetBatchSampler, EpisodeBatchSampler). A bounded queue of future
+batches is kept filled while the training step runs on the gpu, so batch generation overlaps with compute instead of
+running in between steps. Only gen_batch() runs in the background thread, the callbacks' sampler updates still run on
+the training thread (holding the lock, so they wait for any batch being generated).
+
+Updates which change how batches are formed (update_clusters) bump a version counter, and batches generated before
+it are thrown away. Loss and mini-batch cluster updates only change which clusters are likely to be seeded so
+batches queued before them are still used.
+"""
+import queue
+import threading
+
+
+class PrefetchBatchSampler(object):
+
+    def __init__(self, sampler, n_batches=4):
+        """
+        :param sampler: the batch sampler to prefetch from, must have a gen_batch() method
+        :param n_batches: the maximum number of batches generated ahead
+        """
+
+        super(PrefetchBatchSampler, self).__init__()
+
+        # set instance variables
+        self.sampler = sampler
+        self.n_batches = n_batches
+
+        self.lock = threading.Lock()  # held while generating a batch or updating the sampler
+        self.version = 0
+        self.batch_indexes = None  # the indexes of the last batch yielded, used to update losses
+
+    def __getattr__(self, name):
+        # anything else (eg. centroids, cluster_classes) is read from the wrapped sampler
+        if name == 'sampler':
+            raise AttributeError(name)
+        return getattr(self.sampler, name)
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        """
+        yield a batch of indexes, generated ahead in a background thread
+        """
+        batches = queue.Queue(maxsize=self.n_batches)
+        stop = threading.Event()
+
+        def put(item):
+            # wait for space in the queue, but give up if the consumer has stopped
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                while not stop.is_set():
+                    with self.lock:
+                        version = self.version
+                        batch = self.sampler.gen_batch()
+                    if isinstance(batch, tuple):  # magnet also returns the in batch classes
+                        batch = batch[0]
+                    put((version, batch))
+            except Exception as e:
+                put((None, e))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+
+        try:
+            n_yielded = 0
+            while n_yielded < len(self):
+                version, batch = batches.get()
+                if version is None:
+                    raise batch  # the producer failed
+                if version != self.version:
+                    continue  # generated before the sampler was updated
+                self.batch_indexes = batch
+                n_yielded += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
+
+    def update_clusters(self, *args, **kwargs):
+        with self.lock:
+            self.sampler.update_clusters(*args, **kwargs)
+            self.version += 1
+
+    def update_clusters_minibatch(self, batch_reps):
+        with self.lock:
+            self.sampler.update_clusters_minibatch(batch_reps, batch_indexes=self.batch_indexes)
+
+    def update_losses(self, losses):
+        with self.lock:
+            self.sampler.update_losses(losses, batch_indexes=self.batch_indexes)
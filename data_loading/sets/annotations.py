@@ -0,0 +1,165 @@
+"""
+DetectionAnnotations: the annotations of a detection set stored by column rather than as a dict per sample.
+
+Every box of every sample is in a few flat arrays (boxes, gt_classes, gt_overlaps) with per sample offsets into them,
+so a set is a handful of numpy arrays that save to (and load from) a single .npz quickly. AnnotationMapping gives
+the {sample_id: {'boxes', ...}} form the datasets and DetectionWrapper use, making each sample's dict (with the arrays
+as views into the columns) only when it's accessed, so the per sample python objects aren't kept around (and touched
+by the copy on write of every DataLoader worker).
+
+Sets cache their annotations with all of their categories under annotation_cache_key, and take category subsets
+out of them in memory with subset_categories, so any classes config loads from the same cache.
+"""
+import hashlib
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+
+def annotation_cache_key(*parts):
+    """
+    A content address for a set's annotations
+
+    :param parts: everything that determines the annotations (eg. year, split, flags, annotation file mtimes)
+    :return: hex string, the sha1 of the parts
+    """
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+
+class DetectionAnnotations(object):
+
+    def __init__(self, sample_ids, widths, heights, flipped, offsets, boxes, gt_classes, gt_overlaps):
+        """
+        :param sample_ids: (n_samples) array of sample ids
+        :param widths: (n_samples) image widths
+        :param heights: (n_samples) image heights
+        :param flipped: (n_samples) bool, whether the sample is a horizontally flipped image
+        :param offsets: (n_samples + 1) the boxes of sample i are rows offsets[i]:offsets[i+1] of the box columns
+        :param boxes: (n_boxes x 4) uint16 (x1, y1, x2, y2) boxes
+        :param gt_classes: (n_boxes) int32 class labels
+        :param gt_overlaps: (n_boxes x n_categories) float32 overlaps of each box with each class
+        """
+        super(DetectionAnnotations, self).__init__()
+
+        self.sample_ids = np.asarray(sample_ids)
+        self.widths = np.asarray(widths, dtype=np.int32)
+        self.heights = np.asarray(heights, dtype=np.int32)
+        self.flipped = np.asarray(flipped, dtype=bool)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.boxes = np.asarray(boxes, dtype=np.uint16).reshape(-1, 4)
+        self.gt_classes = np.asarray(gt_classes, dtype=np.int32)
+        self.gt_overlaps = np.asarray(gt_overlaps, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.sample_ids)
+
+    @classmethod
+    def from_dict(cls, data, n_categories):
+        """
+        :param data: {sample_id: {'width', 'height', 'flipped', 'boxes', 'gt_classes', 'gt_overlaps'}}
+        :param n_categories: the number of categories (columns of gt_overlaps)
+        """
+        annotations = list(data.values())
+        counts = [len(a['gt_classes']) for a in annotations]
+
+        def column(key, shape):
+            if not annotations:
+                return np.zeros(shape)
+            return np.concatenate([np.asarray(a[key]).reshape((-1,) + shape[1:]) for a in annotations])
+
+        return cls(sample_ids=list(data.keys()),
+                   widths=[a['width'] for a in annotations],
+                   heights=[a['height'] for a in annotations],
+                   flipped=[a['flipped'] for a in annotations],
+                   offsets=np.concatenate([[0], np.cumsum(counts)]),
+                   boxes=column('boxes', (0, 4)),
+                   gt_classes=column('gt_classes', (0,)),
+                   gt_overlaps=column('gt_overlaps', (0, n_categories)))
+
+    def subset_categories(self, labels):
+        """
+        Keep only the boxes of some categories, samples left without any boxes are dropped
+
+        :param labels: the labels to keep, must include the background 0, label labels[i] becomes i
+        :return: DetectionAnnotations of the subset
+        """
+        assert 0 in labels  # ensure background is always included
+        relabel = np.full(self.gt_overlaps.shape[1], -1, dtype=np.int32)
+        relabel[list(labels)] = np.arange(len(labels))
+
+        keep_boxes = relabel[self.gt_classes] >= 0
+        box_samples = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        counts = np.bincount(box_samples[keep_boxes], minlength=len(self))
+        keep_samples = counts > 0
+
+        return DetectionAnnotations(sample_ids=self.sample_ids[keep_samples],
+                                    widths=self.widths[keep_samples],
+                                    heights=self.heights[keep_samples],
+                                    flipped=self.flipped[keep_samples],
+                                    offsets=np.concatenate([[0], np.cumsum(counts[keep_samples])]),
+                                    boxes=self.boxes[keep_boxes],
+                                    gt_classes=relabel[self.gt_classes[keep_boxes]],
+                                    gt_overlaps=self.gt_overlaps[keep_boxes][:, list(labels)])
+
+    def sample(self, i):
+        """
+        :param i: the row of the sample
+        :return: {'width', 'height', 'flipped', 'boxes', 'gt_classes', 'gt_overlaps'}, with the arrays as views of the
+                 columns
+        """
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return {'width': int(self.widths[i]),
+                'height': int(self.heights[i]),
+                'boxes': self.boxes[start:stop],
+                'gt_classes': self.gt_classes[start:stop],
+                'gt_overlaps': self.gt_overlaps[start:stop],
+                'flipped': bool(self.flipped[i])}
+
+    def to_dict(self):
+        """
+        :return: {sample_id: {'width', 'height', 'flipped', 'boxes', 'gt_classes', 'gt_overlaps'}} of every sample
+        """
+        return {sample_id: self.sample(i) for i, sample_id in enumerate(self.sample_ids.tolist())}
+
+    def save(self, path):
+        # write then rename, so a concurrent run never loads a partial file
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f,
+                     sample_ids=self.sample_ids,
+                     widths=self.widths,
+                     heights=self.heights,
+                     flipped=self.flipped,
+                     offsets=self.offsets,
+                     boxes=self.boxes,
+                     gt_classes=self.gt_classes,
+                     gt_overlaps=self.gt_overlaps)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as columns:
+            return cls(**{key: columns[key] for key in columns.files})
+
+
+class AnnotationMapping(Mapping):
+    """A read only {sample_id: annotation dict} view of DetectionAnnotations, the dicts are made on access"""
+
+    def __init__(self, annotations):
+        """
+        :param annotations: the DetectionAnnotations to view
+        """
+        super(AnnotationMapping, self).__init__()
+
+        self.annotations = annotations
+        self.rows = {sample_id: i for i, sample_id in enumerate(annotations.sample_ids.tolist())}
+
+    def __getitem__(self, sample_id):
+        return self.annotations.sample(self.rows[sample_id])
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
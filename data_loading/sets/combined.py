@@ -3,6 +3,8 @@ Used to combine multiple sets together, currently only supports detection sets
 """
 # todo mod classification sets for support
 
+from collections import ChainMap
+
 from torch.utils.data.dataset import Dataset
 
 
@@ -32,16 +34,16 @@ class CombinedDataset(Dataset):
         # merge the datas
         self.sample_ids = []
         self.sample_ids_sets = {}
-        self.data = {}
         for dataset in datasets:
             for sample_id in dataset.data.keys():
-                assert sample_id not in self.data  # ensure the sample_ids are unique across sets
+                assert sample_id not in self.sample_ids_sets  # ensure the sample_ids are unique across sets
                 self.sample_ids.append(sample_id)
-                self.data[sample_id] = dataset.data[sample_id]
                 self.sample_ids_sets[sample_id] = dataset
+        # looked up in the sets' own (possibly lazy) data rather than copied
+        self.data = ChainMap(*[dataset.data for dataset in datasets])
 
     def __len__(self):
-        return len(self.data)
+        return len(self.sample_ids)
 
     def __getitem__(self, index):
         # get the data sample id
@@ -73,7 +75,7 @@ class CombinedDataset(Dataset):
                "# categories: %d\n"\
                "Boxes per image (min, avg, max): %d, %d, %d\n"\
                "Boxes per category (min, avg, max): %d, %d, %d\n" % \
-               (len(self.data), sum(boxes_p_img), len(boxes_p_cls),
+               (len(self.sample_ids), sum(boxes_p_img), len(boxes_p_cls),
                 min(boxes_p_img), sum(boxes_p_img) / len(boxes_p_img), max(boxes_p_img),
                 min(boxes_p_cls), sum(boxes_p_cls) / len(boxes_p_cls), max(boxes_p_cls))
 
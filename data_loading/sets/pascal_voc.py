@@ -24,10 +24,10 @@ import numpy as np
 from PIL import Image, ImageFile
 from os.path import join
 import os
-import scipy.io
 import tarfile
 import shutil
-import pickle
+from functools import partial
+from multiprocessing import Pool
 
 import xml.etree.ElementTree as ET
 
@@ -35,6 +35,7 @@ from torch.utils.data.dataset import Dataset
 from torchvision.datasets.utils import download_url
 
 from utils.download import download
+from data_loading.sets.annotations import DetectionAnnotations, AnnotationMapping, annotation_cache_key
 
 
 class PascalVOCDataset(Dataset):
@@ -51,7 +52,8 @@ class PascalVOCDataset(Dataset):
                  force_download=False,
                  categories_subset=None,
                  use_difficult=False,
-                 use_flipped=False):
+                 use_flipped=False,
+                 load_workers=None):
         """
         :param root_dir: (string) the directory where the dataset will be stored
         :param split: (string) 'train' or 'val'
@@ -62,6 +64,8 @@ class PascalVOCDataset(Dataset):
         :param categories_subset: (iterable) specify a subset of categories to build this set from
         :param use_difficult: (boolean) include samples marked as difficult
         :param use_flipped: (boolean) add horizontally flipped samples
+        :param load_workers: (int) the number of processes to parse the annotation files with, None for all cpus,
+                             splits with fewer than 1000 samples are parsed serially
         """
 
         super(PascalVOCDataset, self).__init__()
@@ -74,6 +78,8 @@ class PascalVOCDataset(Dataset):
         self.target_transform = target_transform
         self.use_difficult = use_difficult
         self.use_flipped = use_flipped
+        self.categories_subset = categories_subset
+        self.load_workers = load_workers or os.cpu_count()
 
         # setup the categories
         self.categories, self.categories_to_labels, self.labels_to_categories = self._init_categories(categories_subset)
@@ -83,7 +89,8 @@ class PascalVOCDataset(Dataset):
         self.download(force=force_download)
 
         # load the data samples for this split
-        self.data = self.load_data_split()  # self.data is gt_roidb (gt_roidb used in some other implementations)
+        self.annotations = self.load_data_split()
+        self.data = AnnotationMapping(self.annotations)  # self.data is gt_roidb (gt_roidb used in some other implementations)
 
         self.sample_ids = list(self.data.keys())
 
@@ -182,91 +189,64 @@ class PascalVOCDataset(Dataset):
 
         sample_ids = [line.strip() for line in lines]
 
+        # the cache holds all the categories, a categories_subset is taken from it in memory
+        all_categories = self._init_categories(None)[1]
+        cache_file = join(self.root_dir, 'VOC'+self.year, 'annotation_cache', self.cache_key(sample_ids) + '.npz')
+
         # load cache if able
-        if cache:
-            if self.n_categories != 21:
-                print("Not using default categories so not caching for now...")
-                # todo load normal cache and delete data entries
+        if cache and os.path.exists(cache_file):
+            annotations = DetectionAnnotations.load(cache_file)
+            print('Cache data loaded from {}'.format(cache_file))
+        else:
+            # parse the annotation files
+            parse = partial(parse_annotation,
+                            root_dir=join(self.root_dir, 'VOC'+self.year),
+                            categories_to_labels=all_categories,
+                            use_difficult=self.use_difficult)
+            if self.load_workers > 1 and len(sample_ids) >= 1000:  # a pool isn't worth starting for a few files
+                with Pool(self.load_workers) as pool:
+                    parsed = pool.map(parse, sample_ids, chunksize=64)
             else:
-                if self.use_flipped:
-                    cache_file = join(self.root_dir, 'VOC'+self.year, self.split+'_data_cache_wflipped.pkl')
-                else:
-                    cache_file = join(self.root_dir, 'VOC'+self.year, self.split+'_data_cache.pkl')
-                if os.path.exists(cache_file):
-                    with open(cache_file, 'rb') as fid:
-                        try:
-                            data = pickle.load(fid)
-                        except:
-                            data = pickle.load(fid, encoding='bytes')
-                    print('Cache data loaded from {}'.format(cache_file))
-                    return data
-
-        # build the data dict
-        data = {}
-        for sample_id in sample_ids:
-            annotation = self._load_annotation(sample_id)
-            if len(annotation['boxes'] > 0):  # only add sample to set if it contains at least one gt box
-                data[sample_id] = annotation
-                if self.use_flipped:
-                    flipped_annotation = self._flip_annotation(annotation, sample_id)
-                    data[sample_id+'_f'] = flipped_annotation
-
-        # save cache if desired
-        if cache and self.n_categories == 21:
-            with open(cache_file, 'wb') as fid:
-                pickle.dump(data, fid, pickle.HIGHEST_PROTOCOL)
-            print('Cache data written to {}'.format(cache_file))
-
-        return data
-
-    def _load_annotation(self, sample_id):
+                parsed = list(map(parse, sample_ids))
+
+            # build the data dict
+            data = {}
+            for sample_id, annotation in zip(sample_ids, parsed):
+                if len(annotation['boxes']) > 0:  # only add sample to set if it contains at least one gt box
+                    data[sample_id] = annotation
+                    if self.use_flipped:
+                        flipped_annotation = self._flip_annotation(annotation)
+                        data[sample_id+'_f'] = flipped_annotation
+
+            # store by column, the sample dicts become views into a few flat arrays
+            annotations = DetectionAnnotations.from_dict(data, len(all_categories))
+
+            # save cache if desired
+            if cache:
+                annotations.save(cache_file)
+                print('Cache data written to {}'.format(cache_file))
+
+        if self.categories_subset:
+            annotations = annotations.subset_categories(self.categories_subset)
+
+        return annotations
+
+    def cache_key(self, sample_ids):
         """
-        Load image and bounding boxes info from XML file in the PASCAL VOC format.
+        The annotation cache key of this set, changes if any of the split's annotation files are modified
+
+        :param sample_ids: the sample ids of the split
         """
-        width, height = self.load_img(sample_id).size
-
-        filename = join(self.root_dir, 'VOC'+self.year, 'Annotations', sample_id + '.xml')
-        tree = ET.parse(filename)
-        objs = tree.findall('object')
-        if not self.use_difficult:
-            # Exclude the samples labeled as difficult
-            non_diff_objs = [obj for obj in objs if int(obj.find('difficult').text) == 0]
-            objs = non_diff_objs
-        num_objs = len(objs)
-
-        boxes = np.zeros((num_objs, 4), dtype=np.uint16)
-        gt_classes = np.zeros((num_objs), dtype=np.int32)
-        overlaps = np.zeros((num_objs, self.n_categories), dtype=np.float32)
-        # "Seg" area for pascal is just the box area
-        seg_areas = np.zeros((num_objs), dtype=np.float32)
-
-        # Load object bounding boxes into a data frame.
-        for ix, obj in enumerate(objs):
-            bbox = obj.find('bndbox')
-            # Make pixel indexes 0-based
-            x1 = float(bbox.find('xmin').text) - 1
-            y1 = float(bbox.find('ymin').text) - 1
-            x2 = float(bbox.find('xmax').text) - 1
-            y2 = float(bbox.find('ymax').text) - 1
-            cls = self.categories_to_labels[obj.find('name').text.lower().strip()]
-            boxes[ix, :] = [x1, y1, x2, y2]
-            gt_classes[ix] = cls
-            overlaps[ix, cls] = 1.0
-            seg_areas[ix] = (x2 - x1 + 1) * (y2 - y1 + 1)
-
-        overlaps = scipy.sparse.csr_matrix(overlaps)
-
-        return {'width': width,
-                'height': height,
-                'boxes': boxes,
-                'gt_classes': gt_classes,
-                'gt_overlaps': overlaps,
-                'flipped': False}#,
-                # 'seg_areas': seg_areas}
+        annotations_dir = join(self.root_dir, 'VOC'+self.year, 'Annotations')
+        mtimes = [os.stat(join(annotations_dir, sample_id + '.xml')).st_mtime_ns for sample_id in sample_ids]
 
-    def _flip_annotation(self, annotation, sample_id):
+        return annotation_cache_key(self.year, self.split, self.use_flipped, self.use_difficult,
+                                    self._init_categories(None)[0], sample_ids, mtimes)
 
-        width = self.load_img(sample_id).size[0]
+    @staticmethod
+    def _flip_annotation(annotation):
+
+        width = annotation['width']
 
         boxes = annotation['boxes'].copy()
         oldx1 = boxes[:, 0].copy()
@@ -369,6 +349,55 @@ class PascalVOCDataset(Dataset):
         return plt
 
 
+def parse_annotation(sample_id, root_dir, categories_to_labels, use_difficult=False):
+    """
+    Load image size and bounding boxes info from XML file in the PASCAL VOC format. A module level function so it
+    can be mapped over a process pool.
+
+    :param sample_id: the sample id (image and annotation filename)
+    :param root_dir: the VOC<year> directory
+    :param categories_to_labels: dict of category name > label
+    :param use_difficult: (boolean) include objects marked as difficult
+    :return: the annotation dict
+    """
+    # the size is in the JPEG header, opening an image doesn't decode the pixels (so truncated files don't matter here)
+    with Image.open(join(root_dir, 'JPEGImages', "%s.jpg" % sample_id)) as img:
+        width, height = img.size
+
+    filename = join(root_dir, 'Annotations', sample_id + '.xml')
+    tree = ET.parse(filename)
+    objs = tree.findall('object')
+    if not use_difficult:
+        # Exclude the samples labeled as difficult
+        non_diff_objs = [obj for obj in objs if int(obj.find('difficult').text) == 0]
+        objs = non_diff_objs
+    num_objs = len(objs)
+
+    boxes = np.zeros((num_objs, 4), dtype=np.uint16)
+    gt_classes = np.zeros((num_objs), dtype=np.int32)
+    overlaps = np.zeros((num_objs, len(categories_to_labels)), dtype=np.float32)
+
+    # Load object bounding boxes into a data frame.
+    for ix, obj in enumerate(objs):
+        bbox = obj.find('bndbox')
+        # Make pixel indexes 0-based
+        x1 = float(bbox.find('xmin').text) - 1
+        y1 = float(bbox.find('ymin').text) - 1
+        x2 = float(bbox.find('xmax').text) - 1
+        y2 = float(bbox.find('ymax').text) - 1
+        cls = categories_to_labels[obj.find('name').text.lower().strip()]
+        boxes[ix, :] = [x1, y1, x2, y2]
+        gt_classes[ix] = cls
+        overlaps[ix, cls] = 1.0
+
+    return {'width': width,
+            'height': height,
+            'boxes': boxes,
+            'gt_classes': gt_classes,
+            'gt_overlaps': overlaps,
+            'flipped': False}
+
+
 if __name__ == "__main__":
     # use this for debugging and checks
     from utils.debug import set_working_dir
@@ -23,7 +23,8 @@ from utils.logging.logger import initialize_logger
 from utils.checkpointing import save_checkpoint, load_checkpoint
 
 from model_definitions.initialize import initialize_model
-from data_loading.initialize import initialize_dataset, initialize_sampler
+from data_loading.initialize import initialize_dataset, initialize_sampler, initialize_loader_options
+from data_loading.device_prefetcher import DevicePrefetcher
 from losses.initialize import initialize_loss
 from callbacks.initialize import initialize_callbacks
 
@@ -114,12 +115,12 @@ def train():
     dataloaders['train'] = torch.utils.data.DataLoader(datasets['train'],
                                                        sampler=samplers['train'],
                                                        batch_size=config.train.batch_size,
-                                                       num_workers=1)
+                                                       **initialize_loader_options(config, 'train'))
     if config.val.every > 0:
         dataloaders['val'] = torch.utils.data.DataLoader(datasets['val'],
                                                          sampler=samplers['val'],
-                                                         batch_size=config.train.batch_size, # todo change to val
-                                                         num_workers=1)
+                                                         batch_size=config.val.batch_size,
+                                                         **initialize_loader_options(config, 'val'))
 
     #################### LOSSES + METRICS ######################
     # Setup losses
@@ -194,25 +195,10 @@ def fit(config,
         is_inception=False,
         resume_from='L'):
 
-    # initilize the tensor holder here.
-    im_data = torch.FloatTensor(1)
-    im_info = torch.FloatTensor(1)
-    num_boxes = torch.LongTensor(1)
-    gt_boxes = torch.FloatTensor(1)
-
-    # ship to cuda
-    im_data = im_data.cuda()
-    im_info = im_info.cuda()
-    num_boxes = num_boxes.cuda()
-    gt_boxes = gt_boxes.cuda()
-
-    # make variable
-    from torch.autograd import Variable
-    im_data = Variable(im_data)
-    im_info = Variable(im_info)
-    num_boxes = Variable(num_boxes)
-    gt_boxes = Variable(gt_boxes)
-
+    # the batches are (im_data, im_info, gt_boxes, num_boxes), staged on the gpu ahead of each step
+    prefetchers = {'train': DevicePrefetcher(dataloaders['train'], device, enabled=config.train.device_prefetch)}
+    if 'val' in dataloaders:
+        prefetchers['val'] = DevicePrefetcher(dataloaders['val'], device, enabled=config.val.device_prefetch)
 
     since = time.time()
 
@@ -259,15 +245,12 @@ def fit(config,
         # Iterate over data.
         model.train()
         batch = 0
+        n_images = 0
+        epoch_since = time.time()
         print('Doing %d batches...' % len(dataloaders['train']))
-        for data in dataloaders['train']:  # this gets a batch (or an episode)
-            # inputs = inputs.to(device)
-            # labels = labels.to(device)
-
-            im_data.data.resize_(data[0].size()).copy_(data[0])
-            im_info.data.resize_(data[1].size()).copy_(data[1])
-            gt_boxes.data.resize_(data[2].size()).copy_(data[2])
-            num_boxes.data.resize_(data[3].size()).copy_(data[3])
+        for data in prefetchers['train']:  # this gets a batch (or an episode)
+            im_data, im_info, gt_boxes, num_boxes = data
+            n_images += im_data.size(0)
 
             # zero the parameter gradients
             model.zero_grad()
@@ -315,6 +298,11 @@ def fit(config,
         avg_rpn_acc = np.mean(train_rpn_acc[-batch:])
         avg_rcnn_acc = np.mean(train_rcnn_acc[-batch:])
 
+        epoch_elapsed = time.time() - epoch_since
+        throughput = 'Trained on {} images in {:.1f}s ({:.1f} images/sec)'.format(n_images, epoch_elapsed, n_images / max(epoch_elapsed, 1e-8))
+        print(throughput)
+        logger.info(throughput)
+
         print(
             'Avg Train: Total Loss {:.4f}, RPN Class Loss {:.4f}, RPN Box Loss {:.4f}, RPN Acc: {:.4f}, RCNN Class Loss {:.4f}, RCNN Box Loss {:.4f}, RCNN Acc: {:.4f}'.format(
                 avg_loss, np.mean(train_rpn_loss_cls), np.mean(train_rpn_loss_box), avg_rpn_acc,
@@ -344,14 +332,8 @@ def fit(config,
             val_rcnn_loss_cls = []
             val_rcnn_loss_bbox = []
             print("Validation with %d batches" % len(dataloaders['val']))
-            for data in dataloaders['val']:
-                # v_inputs = v_inputs.to(device)
-                # v_labels = v_labels.to(device)
-
-                im_data.data.resize_(data[0].size()).copy_(data[0])
-                im_info.data.resize_(data[1].size()).copy_(data[1])
-                gt_boxes.data.resize_(data[2].size()).copy_(data[2])
-                num_boxes.data.resize_(data[3].size()).copy_(data[3])
+            for data in prefetchers['val']:
+                im_data, im_info, gt_boxes, num_boxes = data
 
                 # print(gt_boxes)
 
@@ -27,13 +27,18 @@ def initialize_loss(config, loss_name, split='train', n_classes=None):
         assert n_classes is not None
         if split == 'train':
             return RepmetLoss(N=n_classes, k=config.train.k, emb_size=config.model.emb_size,
-                              alpha=config.train.alpha, sigma=config.train.sigma, dist=config.model.dist)
+                              alpha=config.train.alpha, sigma=config.train.sigma, dist=config.model.dist,
+                              soft_acc=config.train.soft_acc)
         elif split == 'val':
             return RepmetLoss(N=n_classes, k=config.train.k, emb_size=config.model.emb_size,
-                              alpha=config.val.alpha, sigma=config.val.sigma, dist=config.model.dist)
+                              alpha=config.val.alpha, sigma=config.val.sigma, dist=config.model.dist,
+                              index_lists=config.model.rep_index_lists, index_probe=config.model.rep_index_probe,
+                              top_l=config.model.rep_index_top_l)
         elif split == 'test':
             return RepmetLoss(N=n_classes, k=config.train.k, emb_size=config.model.emb_size,
-                              alpha=config.test.alpha, sigma=config.test.sigma, dist=config.model.dist)
+                              alpha=config.test.alpha, sigma=config.test.sigma, dist=config.model.dist,
+                              index_lists=config.model.rep_index_lists, index_probe=config.model.rep_index_probe,
+                              top_l=config.model.rep_index_top_l)
         else:
             raise ValueError("Split '%s' not recognised for the %s loss." % (split, loss_name))
 
@@ -6,9 +6,10 @@ import numpy as np
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.nn.functional as F
 
+from utils.distances import euclidean_distance
+
 
 class MagnetLoss(nn.Module):
     """
@@ -30,66 +31,69 @@ class MagnetLoss(nn.Module):
     """
     def __init__(self, m, d, alpha=1.0, L=128, style='closest'):
         super(MagnetLoss, self).__init__()
-        self.r = None
         self.classes = None
         self.clusters = None
         self.cluster_classes = None
-        self.n_clusters = None
         self.alpha = alpha
         self.L = L
         self.style = style
         self.n_clusters = m
         self.examples_per_cluster = d
-        self.variances = torch.tensor([0.0])
 
-    def forward(self, input, target):  # reps and classes, x and y
+        # cluster index tensors only depend on (m, d) so are built once per device and reused
+        self.cluster_indexes = {}
+
+        # running statistics of the batch variances, kept on the device of the input so no sync each step
+        self.last_variance = None
+        self.variance_sum = None
+        self.n_variances = 0
+
+    def get_cluster_indexes(self, device):
+        """Get the (m*d) cluster index of each example and the (m) index of each cluster for a device"""
+        key = (self.n_clusters, self.examples_per_cluster, device)
+        if key not in self.cluster_indexes:
+            cluster_range = torch.arange(self.n_clusters, dtype=torch.long, device=device)
+            clusters = cluster_range.repeat_interleave(self.examples_per_cluster)
+            self.cluster_indexes[key] = (clusters, cluster_range)
+        return self.cluster_indexes[key]
+
+    def mean_variance(self):
+        """The mean of the batch variances seen so far in training"""
+        if self.n_variances < 1:
+            return None
+        return self.variance_sum / self.n_variances
 
-        GPU_INT_DTYPE = torch.cuda.IntTensor
-        GPU_LONG_DTYPE = torch.cuda.LongTensor
-        GPU_FLOAT_DTYPE = torch.cuda.FloatTensor
+    def forward(self, input, target):  # reps and classes, x and y
 
-        self.r = input
-        classes = target.cpu().numpy()
-        self.classes = torch.from_numpy(classes).type(GPU_LONG_DTYPE)
-        self.clusters, _ = torch.sort(torch.arange(0, float(self.n_clusters)).repeat(self.examples_per_cluster))
-        self.clusters = self.clusters.type(GPU_INT_DTYPE)
+        self.classes = target.long()
+        self.clusters, cluster_range = self.get_cluster_indexes(input.device)
         self.cluster_classes = self.classes[0:self.n_clusters*self.examples_per_cluster:self.examples_per_cluster]
 
-        # Take cluster means within the batch
-        cluster_examples = dynamic_partition(self.r, self.clusters, self.n_clusters)
-
-        cluster_means = torch.stack([torch.mean(x, dim=0) for x in cluster_examples])
-
-        sample_costs = compute_euclidean_distance(cluster_means, expand_dims(self.r, 1))
-
-        self.sample_costs = sample_costs
-
-        clusters_tensor = self.clusters.type(GPU_FLOAT_DTYPE)
-        n_clusters_tensor = torch.arange(0, self.n_clusters).type(GPU_FLOAT_DTYPE)
+        # Take cluster means within the batch, examples of a cluster are consecutive
+        cluster_means = input.view(self.n_clusters, self.examples_per_cluster, -1).mean(1)
 
-        intra_cluster_mask = Variable(comparison_mask(clusters_tensor, n_clusters_tensor).type(GPU_FLOAT_DTYPE))
+        sample_costs = euclidean_distance(input, cluster_means)
 
-        intra_cluster_costs = torch.sum(intra_cluster_mask * sample_costs, dim=1)
+        intra_cluster_costs = sample_costs.gather(1, self.clusters.unsqueeze(1)).squeeze(1)
 
-        N = self.r.size()[0]  # N = M*D (Batch size)
+        N = input.size()[0]  # N = M*D (Batch size)
 
         variance = torch.sum(intra_cluster_costs) / float(N - 1)
 
-        # self.variances = np.hstack((self.variances, variance.data.cpu().numpy()))
-        self.variances = torch.cat((self.variances, variance.unsqueeze(0).cpu()), 0)
+        # keep a running mean rather than the full history
+        self.last_variance = variance.detach()
+        if self.variance_sum is None:
+            self.variance_sum = torch.zeros_like(self.last_variance)
+        self.variance_sum = self.variance_sum + self.last_variance
+        self.n_variances += 1
 
         var_normalizer = -1 / (2 * variance**2)
 
         # Compute numerator
         numerator = torch.exp(var_normalizer * intra_cluster_costs - self.alpha)
 
-        classes_tensor = self.classes.type(GPU_FLOAT_DTYPE)
-        cluster_classes_tensor = self.cluster_classes.type(GPU_FLOAT_DTYPE)
-
         # Compute denominator
-        diff_class_mask = Variable(comparison_mask(classes_tensor, cluster_classes_tensor).type(GPU_FLOAT_DTYPE))
-
-        diff_class_mask = 1 - diff_class_mask  # Logical not on ByteTensor
+        diff_class_mask = comparison_mask(self.classes, self.cluster_classes).logical_not().type_as(sample_costs)
 
         denom_sample_costs = torch.exp(var_normalizer * sample_costs)
 
@@ -101,10 +105,9 @@ class MagnetLoss(nn.Module):
 
         total_loss = torch.mean(losses)
 
-
         if self.style == 'closest':  # acts on the clusters in this batch/episode rather than those calculate over the entire set!!
             _, pred = sample_costs.min(1)
-            acc = pred.eq(clusters_tensor.type(GPU_LONG_DTYPE)).float().mean()
+            acc = pred.eq(self.clusters).float().mean()
         else:
             raise NotImplementedError
             # TODO implement the version that takes into account variance
@@ -148,62 +151,70 @@ class MagnetLossEval(nn.Module):
         super(MagnetLossEval, self).__init__()
         self.cluster_means = None
         self.cluster_classes = None
+        self.num_classes = None
         self.variance = None
         self.L = L
         self.style = style
 
-    def forward(self, input, target):  # reps and classes, x and y # expects batch size of 1
+    def set_clusters(self, cluster_means, cluster_classes):
+        """
+        Upload the cluster means and their classes once, rather than converting them on every forward
+
+        :param cluster_means: (C x D) array of the cluster centroids
+        :param cluster_classes: (C) array of the class of each cluster
+        """
+        # copies, as_tensor would share memory with the sampler's arrays, which minibatch updates change in place
+        self.cluster_means = torch.tensor(np.asarray(cluster_means), dtype=torch.float)
+        self.cluster_classes = torch.tensor(np.asarray(cluster_classes), dtype=torch.long)
+        self.num_classes = int(self.cluster_classes.max().item()) + 1  # the number of classes of the dataset
+
+    def forward(self, input, target):  # reps and classes, x and y, works on a whole batch
 
         # make sure these have been set with the callbacks!!
         assert self.cluster_means is not None
         assert self.cluster_classes is not None
         assert self.variance is not None
 
-        GPU_INT_DTYPE = torch.cuda.IntTensor
-        GPU_LONG_DTYPE = torch.cuda.LongTensor
-        GPU_FLOAT_DTYPE = torch.cuda.FloatTensor
+        # move the clusters to the device of the input once, they stay there until set again
+        if self.cluster_means.device != input.device:
+            self.cluster_means = self.cluster_means.to(input.device)
+            self.cluster_classes = self.cluster_classes.to(input.device)
 
-        num_classes = np.max(self.cluster_classes) + 1  # the number of classes of the dataset
-        cluster_means = torch.from_numpy(self.cluster_means).type(GPU_FLOAT_DTYPE)
-        cluster_classes = torch.from_numpy(self.cluster_classes).type(GPU_LONG_DTYPE)
-        sample_costs = compute_euclidean_distance(cluster_means, expand_dims(input, 1))
+        # (B x C) squared distances in a single matmul
+        input = input.view(input.size(0), -1).float()
+        sample_costs = euclidean_distance(input, self.cluster_means)
 
         if self.style == 'closest':
             _, pred = sample_costs.min(1)
-            pred = cluster_classes[pred]
-            acc = pred.eq(target).float()
+            pred = self.cluster_classes[pred]
+            acc = pred.eq(target).float().mean()
             return torch.zeros(1), torch.zeros(1), pred, acc
         else:
-            num_clusters = cluster_means.size()[0]
-
-            # Sort the clusters by closest distance to sample
-            sorted_sample_costs, indices = torch.sort(sample_costs)
-            sorted_sample_costs = sorted_sample_costs.squeeze()
-            indices = indices.type(GPU_LONG_DTYPE).squeeze()
-            sorted_cluster_classes = cluster_classes[indices]
+            num_clusters = sample_costs.size(1)
 
-            # If L < num_clusters then lets only take the top L
+            # Only take the L closest clusters, no need to sort them
             if self.L < num_clusters:
-                sorted_sample_costs = sorted_sample_costs[:self.L]
-                sorted_cluster_classes = sorted_cluster_classes[:self.L]
-                num_clusters = self.L
+                sample_costs, indices = sample_costs.topk(self.L, dim=1, largest=False, sorted=False)
+                sample_cluster_classes = self.cluster_classes[indices]
+            else:
+                sample_cluster_classes = self.cluster_classes.unsqueeze(0).expand_as(sample_costs)
 
             var_normalizer = -1 / (2 * self.variance ** 2)
 
-            normalised_costs = torch.exp(var_normalizer * sorted_sample_costs).type(GPU_FLOAT_DTYPE)
+            normalised_costs = torch.exp(var_normalizer * sample_costs)
 
-            per_class_costs = torch.zeros(num_classes, num_clusters).type(GPU_FLOAT_DTYPE)
-            per_class_costs = per_class_costs.scatter_(0, sorted_cluster_classes.unsqueeze(0), normalised_costs.unsqueeze(0))
-            numerator = per_class_costs.sum(1)
+            per_class_costs = torch.zeros(input.size(0), self.num_classes, dtype=normalised_costs.dtype,
+                                          device=normalised_costs.device)
+            numerator = per_class_costs.scatter_add_(1, sample_cluster_classes, normalised_costs)
 
-            denominator = torch.sum(normalised_costs)
+            denominator = torch.sum(normalised_costs, dim=1, keepdim=True)
 
             epsilon = 1e-8
 
             probs = numerator / (denominator + epsilon)
 
-            _, pred = probs.max(0)
-            acc = pred.eq(target).float()
+            _, pred = probs.max(1)
+            acc = pred.eq(target).float().mean()
 
             return torch.zeros(1), torch.zeros(1), pred, acc
 
@@ -232,4 +243,5 @@ def dynamic_partition(X, partitions, n_clusters):
 
 
 def compute_euclidean_distance(x, y):
-    return torch.sum((x - y)**2, dim=2)
+    """Squared distances between x (M x D) and the expanded y (N x 1 x D), see utils.distances for the matmul form"""
+    return euclidean_distance(y.squeeze(1), x)
@@ -6,7 +6,7 @@ import torch
 from torch.nn import functional as F
 from torch.nn.modules import Module
 
-from utils.functions import euclidean_distance
+from utils.distances import euclidean_distance
 
 class PrototypicalLoss(Module):
     '''
@@ -34,40 +34,49 @@ def prototypical_loss(input, target, n_support):
     - input: the model output for a batch of samples
     - target: ground truth for the above batch of samples
     - n_support: number of samples to keep in account when computing
-      barycentres, for each one of the current classes
-    '''
-    target_cpu = target.to('cpu')
-    input_cpu = input.to('cpu')
+      barycentres, for each one of the current classes, the first n_support
+      samples of each class in the batch are the support, the rest are queries
+      (classes can have different numbers of queries). Either an int, or a
+      sequence / tensor of the shots of each class (in sorted class order) for
+      episodes with variable shots
 
-    def supp_idxs(c):
-        # FIXME when torch will support where as np
-        return target_cpu.eq(c).nonzero()[:n_support].squeeze(1)
+    Everything stays on the device of input, prototypes are summed with a
+    single index_add rather than a loop over the classes, and divided by the
+    actual number of supports of each class.
 
-    # FIXME when torch.unique will be available on cuda too
-    classes = torch.unique(target_cpu)
+    Returns the total loss, the per query losses and the predicted class
+    indexes (into the sorted classes of the batch) and the accuracy, with the
+    queries ordered by class.
+    '''
+    classes, target_inds = torch.unique(target, sorted=True, return_inverse=True)
     n_classes = len(classes)
-    # FIXME when torch will support where as np
-    # assuming n_query, n_target constants
-    n_query = target_cpu.eq(classes[0].item()).sum().item() - n_support
-
-    support_idxs = list(map(supp_idxs, classes))
 
-    prototypes = torch.stack([input_cpu[idx_list].mean(0) for idx_list in support_idxs])
-    # FIXME when torch will support where as np
-    query_idxs = torch.stack(list(map(lambda c: target_cpu.eq(c).nonzero()[n_support:], classes))).view(-1)
+    # the rank of each sample amongst the samples of its class, in batch order
+    order = torch.argsort(target_inds, stable=True)
+    counts = torch.bincount(target_inds, minlength=n_classes)
+    offsets = torch.cumsum(counts, 0) - counts
+    ranks = torch.empty_like(order)
+    ranks[order] = torch.arange(len(order), device=order.device) - offsets[target_inds[order]]
+    n_support = torch.as_tensor(n_support, dtype=torch.long, device=target.device)
+    if n_support.dim() > 0:
+        n_support = n_support[target_inds]  # the shots of each sample's class
+    is_support = ranks < n_support
 
-    query_samples = input.to('cpu')[query_idxs]
-    dists = euclidean_distance(query_samples, prototypes)
+    # average the supports of each class
+    n_supports = torch.bincount(target_inds[is_support], minlength=n_classes).clamp(min=1).unsqueeze(1).type_as(input)
+    prototypes = input.new_zeros((n_classes, input.size(1)))
+    prototypes = prototypes.index_add(0, target_inds[is_support], input[is_support]) / n_supports
 
-    log_p_y = F.log_softmax(-dists, dim=1).view(n_classes, n_query, -1)
+    # the queries ordered by class
+    query_idxs = order[~is_support[order]]
+    query_inds = target_inds[query_idxs]
+    dists = euclidean_distance(input[query_idxs], prototypes)
 
-    target_inds = torch.arange(0, n_classes)
-    target_inds = target_inds.view(n_classes, 1, 1)
-    target_inds = target_inds.expand(n_classes, n_query, 1).long()
+    log_p_y = F.log_softmax(-dists, dim=1)
 
-    losses = -log_p_y.gather(2, target_inds).squeeze().view(-1)
+    losses = -log_p_y.gather(1, query_inds.unsqueeze(1)).squeeze(1)
     total_loss = torch.mean(losses)
-    _, pred = log_p_y.max(2)
-    acc = pred.eq(target_inds.squeeze()).float().mean()
+    _, pred = log_p_y.max(1)
+    acc = pred.eq(query_inds).float().mean()
 
     return total_loss, losses, pred, acc
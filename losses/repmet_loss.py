@@ -2,12 +2,17 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from utils.functions import make_one_hot, euclidean_distance, cosine_distance
+from utils.distances import euclidean_distance, cosine_distance
+from utils.kmeans import batched_kmeans
+from utils.rep_index import RepIndex
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 
 class RepmetLoss(nn.Module):
 
-    def __init__(self, N, k, emb_size, alpha=1.0, sigma=0.5, dist='euc'):
+    def __init__(self, N, k, emb_size, alpha=1.0, sigma=0.5, dist='euc', soft_acc=True,
+                 index_lists=0, index_probe=8, top_l=128, capacity=None):
         super(RepmetLoss, self).__init__()
         self.N = N
         self.k = k
@@ -15,9 +20,34 @@ class RepmetLoss(nn.Module):
         self.alpha = alpha
         self.sigma = sigma
         self.dist = dist
+        self.soft_acc = soft_acc  # if False pred / acc come from the closest rep, skipping the probabilities
+
+        # the reps are a view of the first N*k rows of a preallocated store, so classes can be registered in place
+        # (a buffer so it moves with the module, not persistent as the reps are already in the state dict)
+        self.register_buffer('rep_store', torch.zeros((max(N, capacity or 0) * k, emb_size), dtype=torch.float,
+                                                      device=device), persistent=False)
+        self.rep_store[:N*k] = F.normalize(torch.randn(N*k, emb_size, dtype=torch.float, device=device))
+        self.reps = nn.Parameter(self.rep_store[:N*k])
+
+        # removed class ids, kept (so ids stay stable) but never predicted, their slots are reused by register_class
+        self.removed = []
+        self.removed_mask = None
+        self.classes_version = 0
+
+        # optional approximate nearest rep index, so only the top_l closest reps of each sample are scored
+        self.top_l = top_l
+        self.index = RepIndex(n_lists=index_lists, n_probe=index_probe, dist=dist) if index_lists > 0 else None
+        self.index_state = None  # the reps the index was built on, rebuilt if they change
 
-        # TODO mod this from hardcoded with the device
-        self.reps = nn.Parameter(F.normalize(torch.randn(N*k, emb_size, dtype=torch.float).cuda()))
+    def _apply(self, fn, *args, **kwargs):
+        # .to() / .cuda() convert the store and the reps separately, make the reps a view of the store again
+        super(RepmetLoss, self)._apply(fn, *args, **kwargs)
+        n_reps = len(self.reps)
+        if len(self.rep_store) >= n_reps and self.rep_store.dtype == self.reps.dtype \
+                and self.rep_store.data_ptr() != self.reps.data_ptr():
+            self.rep_store[:n_reps] = self.reps.data
+            self.reps.data = self.rep_store[:n_reps]
+        return self
 
     def forward(self, input, target):
         """
@@ -30,6 +60,10 @@ class RepmetLoss(nn.Module):
         """
         # batch size
         self.n_samples = len(target)
+        target = target.long().view(-1, 1)
+
+        if self.index is not None:
+            return self.forward_indexed(input, target)
 
         # self.reps.data = F.normalize(self.reps)
 
@@ -39,20 +73,14 @@ class RepmetLoss(nn.Module):
         else:
             distances = euclidean_distance(input, self.reps)
 
+        # distance to the closest rep of each class
+        class_distances, _ = distances.view(-1, self.N, self.k).min(2)
+        if self.removed_mask is not None:
+            class_distances = class_distances.masked_fill(self.removed_mask, float('inf'))
 
-        # make mask with ones where correct class, zeros otherwise
-        mask = make_one_hot(target, n_classes=self.N).cuda()
-        mask_cor = mask.transpose(0, 1).repeat(1, self.k).view(-1, self.n_samples).transpose(0, 1)
-        mask_inc = ~mask_cor
-
-        valmax, argmax = distances.max(-1)
-        valmax, argmax = valmax.max(-1)
-        valmax += 10
-
-        cor = distances + (valmax*mask_inc.float())
-        inc = distances + (mask_cor.float()*valmax)
-        min_cor, _ = cor.min(1)
-        min_inc, _ = inc.min(1)
+        # closest rep of the correct class, and closest of any incorrect class (correct class masked out)
+        min_cor = class_distances.gather(1, target).squeeze(1)
+        min_inc, _ = class_distances.scatter(1, target, float('inf')).min(1)
 
         # Eqn. 4 of repmet paper
         losses = F.relu(min_cor - min_inc + self.alpha)
@@ -60,17 +88,55 @@ class RepmetLoss(nn.Module):
         # mean the sample losses over the batch
         total_loss = torch.mean(losses)
 
-        # Eqn. 1 of repmet paper
-        probs = torch.exp(- distances / (2 * self.sigma ** 2))  # todo is the dist meant to be squared?
+        if self.soft_acc:
+            # Eqn. 1 of repmet paper
+            probs = torch.exp(- distances / (2 * self.sigma ** 2))  # todo is the dist meant to be squared?
 
-        # Eqn 2. of repmet paper
-        hard_probs, _ = probs.view(-1, self.N, self.k).max(2)
+            # classification (soft) version of eqn 2 (considers all the ks for a class) (eqn 5 of repmet paper)
+            numerator = probs.view(-1, self.N, self.k).sum(2)
+            if self.removed_mask is not None:
+                numerator = numerator.masked_fill(self.removed_mask, 0)
+            denominator = numerator.sum(1).view(-1, 1)
 
-        # Eqn 3. of repmet paper
-        back_p = 1 - hard_probs.max(1)[0]  # todo useful for detection
+            epsilon = 1e-8
+
+            soft_probs = numerator / (denominator + epsilon) + epsilon
+
+            _, pred = soft_probs.max(1)
+        else:
+            # just the smallest distances, equiv if k=1
+            _, pred = class_distances.min(1)
+
+        acc = pred.eq(target.squeeze(1)).float().mean()
+
+        return total_loss, losses, pred, acc
 
-        # classification (soft) version of eqn 2 (considers all the ks for a class) (eqn 5 of repmet paper)
-        numerator = probs.view(-1, self.N, self.k).sum(2)
+    def forward_indexed(self, input, target):
+        """
+        As forward but only scores the top_l reps of each sample found with the index, the closest correct rep is
+        still exact (there are only k of them)
+        """
+        self.update_index()
+        distances, rep_idxs = self.index.search(input, self.top_l)  # inf and -1 where too few candidates
+        rep_classes = rep_idxs.clamp(min=0) // self.k
+
+        # the k reps of the correct class
+        cor_reps = self.reps[target * self.k + torch.arange(self.k, device=target.device)]
+        if self.dist == 'cos':
+            cor_distances = 1 - F.cosine_similarity(input.unsqueeze(1), cor_reps, dim=2)
+        else:
+            cor_distances = ((input.unsqueeze(1) - cor_reps) ** 2).sum(2)
+        min_cor, _ = cor_distances.min(1)
+        min_inc, _ = distances.masked_fill(rep_classes == target, float('inf')).min(1)
+
+        # Eqn. 4 of repmet paper
+        losses = F.relu(min_cor - min_inc + self.alpha)
+        total_loss = torch.mean(losses)
+
+        # Eqn. 1 and 5 of repmet paper, reps that aren't candidates contribute nothing
+        probs = torch.exp(- distances / (2 * self.sigma ** 2))
+        numerator = torch.zeros((len(input), self.N), dtype=probs.dtype, device=probs.device)
+        numerator = numerator.scatter_add_(1, rep_classes, probs)
         denominator = numerator.sum(1).view(-1, 1)
 
         epsilon = 1e-8
@@ -78,25 +144,113 @@ class RepmetLoss(nn.Module):
         soft_probs = numerator / (denominator + epsilon) + epsilon
 
         _, pred = soft_probs.max(1)
-        acc = pred.eq(target.squeeze()).float().mean()
-
-        # calc a second acc.. just the smallest distances, equiv if k=1
-        d = distances.view(-1, self.N, self.k)
-        dm, _ = d.min(2)
-        _, dma = dm.min(1)
-        acc_b = dma.eq(target.squeeze()).float().mean()
+        acc = pred.eq(target.squeeze(1)).float().mean()
 
         return total_loss, losses, pred, acc
 
+    def reps_changed(self):
+        """
+        Mark the reps as changed (eg. after an optimizer step), so the index is rebuilt before it's next searched
+
+        The count is kept on the reps Parameter itself, so every loss sharing them (eg. the val loss after
+        UpdateValReps) sees the change, whichever of them it was marked through.
+        """
+        self.reps.rep_version = getattr(self.reps, 'rep_version', 0) + 1
+
+    def update_index(self):
+        """Rebuild the index if the reps have been set, replaced or stepped since it was built"""
+        state = (self.reps.data_ptr(), self.N, self.classes_version, getattr(self.reps, 'rep_version', 0))
+        if state != self.index_state:
+            valid = None
+            if self.removed_mask is not None:
+                valid = self.removed_mask.logical_not().repeat_interleave(self.k)
+            self.index.build(self.reps, valid=valid)
+            self.index_state = state
+
     def get_reps(self):
         return self.reps.data.cpu().detach().numpy()
 
     def set_reps(self, reps, start=None, stop=None):
+        reps = torch.as_tensor(reps, dtype=torch.float, device=self.reps.device)
         if start is not None and stop is not None:
-            self.reps.data[start:stop] = torch.Tensor(reps).cuda().float()
+            self.reps.data[start:stop] = reps
+        elif reps.shape == self.reps.shape:
+            self.reps.data.copy_(reps)  # in place, so the reps stay a view of the store
+        else:
+            self.reps.data = reps
+        self.reps_changed()
+
+        if self.index is not None:
+            self.update_index()
+
+    def reserve(self, n_classes):
+        """
+        Preallocate the rep store for n_classes, so registering classes up to it doesn't reallocate
+
+        :param n_classes: the total number of classes to make room for
+        """
+        # the reps are replaced (eg. set_reps or .to()) rather than a view of the store, start a new one from them
+        aliased = self.rep_store.device == self.reps.device and self.rep_store.data_ptr() == self.reps.data_ptr()
+        if aliased and len(self.rep_store) >= n_classes * self.k:
+            return
+
+        store = torch.zeros((max(n_classes, 2 * self.N) * self.k, self.emb_size),
+                            dtype=self.reps.dtype, device=self.reps.device)
+        store[:self.N * self.k] = self.reps.data
+        self.rep_store = store
+        self.reps.data = store[:self.N * self.k]
+
+    def register_class(self, embeddings, optimizer=None):
+        """
+        Enroll a new class from a few of its embeddings without retraining, its k reps are their k-means centroids
+
+        A new class (rather than a reused removed slot) grows the reps, so any optimizer state of the reps (eg. momentum
+        or Adam moments) has the old shape. Pass the optimizer to reset that state, or rebuild the optimizer.
+
+        :param embeddings: (n_shots x emb_size) embeddings of examples of the new class
+        :param optimizer: optional optimizer of the reps, their state is reset
+        :return: the id of the new class, what pred will give for it
+        """
+        embeddings = torch.as_tensor(embeddings, dtype=torch.float, device=self.reps.device).view(-1, self.emb_size)
+        centroids, _ = batched_kmeans(embeddings, torch.zeros(len(embeddings), dtype=torch.long), 1, self.k)
+        centroids = torch.as_tensor(centroids, dtype=self.reps.dtype, device=self.reps.device)
+
+        if self.removed:
+            # reuse the slot of a removed class
+            class_id = self.removed.pop(0)
+            self.reps.data[class_id * self.k:(class_id + 1) * self.k] = centroids
+        else:
+            class_id = self.N
+            self.reserve(self.N + 1)
+            self.rep_store[self.N * self.k:(self.N + 1) * self.k] = centroids
+            self.N += 1
+            self.reps.data = self.rep_store[:self.N * self.k]
+
+        if optimizer is not None:
+            optimizer.state.pop(self.reps, None)
+
+        self.update_removed_mask()
+        return class_id
+
+    def remove_class(self, class_id):
+        """
+        Stop predicting a class, other class ids are unchanged. The reps keep their shape, so optimizer state stays valid
+
+        :param class_id: the id of the class to remove
+        """
+        if class_id < 0 or class_id >= self.N or class_id in self.removed:
+            raise ValueError("no class {} to remove".format(class_id))
+        self.removed.append(class_id)
+        self.removed.sort()
+        self.update_removed_mask()
+
+    def update_removed_mask(self):
+        self.classes_version += 1
+        if self.removed:
+            self.removed_mask = torch.zeros(self.N, dtype=torch.bool, device=self.reps.device)
+            self.removed_mask[self.removed] = True
         else:
-            # self.reps = nn.Parameter(torch.Tensor(reps, dtype=torch.float).cuda())
-            self.reps.data = torch.Tensor(reps).cuda().float()
+            self.removed_mask = None
 
 if __name__ == "__main__":
     print("Simple test of emb loss")
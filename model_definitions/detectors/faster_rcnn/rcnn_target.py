@@ -16,7 +16,7 @@ import torch
 import torch.nn as nn
 import numpy as np
 
-from bbox_transform import bbox_overlaps_batch, bbox_transform_batch
+from .bbox_transform import bbox_overlaps_batch, bbox_transform_batch
 
 
 class RCNNTargetSampler(nn.Module):
@@ -85,76 +85,45 @@ class RCNNTargetSampler(nn.Module):
         # changed indexing way for pytorch 1.0
         labels = gt_boxes[:,:,4].contiguous().view(-1)[(offset.view(-1),)].view(batch_size, -1)
 
-        labels_batch = labels.new(batch_size, rois_per_image).zero_()
-        rois_batch  = all_rois.new(batch_size, rois_per_image, 5).zero_()
-        gt_rois_batch = all_rois.new(batch_size, rois_per_image, 5).zero_()
-        # Guard against the case when an image has fewer than max_fg_rois_per_image
-        # foreground RoIs
-        for i in range(batch_size):
-
-            fg_inds = torch.nonzero(max_overlaps[i] >= self.FG_THRESH).view(-1)
-            fg_num_rois = fg_inds.numel()
-
-            # Select background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
-            bg_inds = torch.nonzero((max_overlaps[i] < self.BG_THRESH_HI) &
-                                    (max_overlaps[i] >= self.BG_THRESH_LO)).view(-1)
-            bg_num_rois = bg_inds.numel()
-
-            if fg_num_rois > 0 and bg_num_rois > 0:
-                # sampling fg
-                fg_rois_per_this_image = min(fg_rois_per_image, fg_num_rois)
-
-                # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-                # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-                # use numpy instead.
-                #rand_num = torch.randperm(fg_num_rois).long().cuda()
-                rand_num = torch.from_numpy(np.random.permutation(fg_num_rois)).type_as(gt_boxes).long()
-                fg_inds = fg_inds[rand_num[:fg_rois_per_this_image]]
-
-                # sampling bg
-                bg_rois_per_this_image = rois_per_image - fg_rois_per_this_image
-
-                # Seems torch.rand has a bug, it will generate very large number and make an error.
-                # We use numpy rand instead.
-                #rand_num = (torch.rand(bg_rois_per_this_image) * bg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(bg_rois_per_this_image) * bg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-                bg_inds = bg_inds[rand_num]
-
-            elif fg_num_rois > 0 and bg_num_rois == 0:
-                # sampling fg
-                #rand_num = torch.floor(torch.rand(rois_per_image) * fg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(rois_per_image) * fg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-                fg_inds = fg_inds[rand_num]
-                fg_rois_per_this_image = rois_per_image
-                bg_rois_per_this_image = 0
-            elif bg_num_rois > 0 and fg_num_rois == 0:
-                # sampling bg
-                #rand_num = torch.floor(torch.rand(rois_per_image) * bg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(rois_per_image) * bg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-
-                bg_inds = bg_inds[rand_num]
-                bg_rois_per_this_image = rois_per_image
-                fg_rois_per_this_image = 0
-            else:
-                raise ValueError("bg_num_rois = 0 and fg_num_rois = 0, this should not happen!")
-
-            # The indices that we're selecting (both fg and bg)
-            keep_inds = torch.cat([fg_inds, bg_inds], 0)
-
-            # Select sampled values from various arrays:
-            labels_batch[i].copy_(labels[i][keep_inds])
-
-            # Clamp labels for the background RoIs to 0
-            if fg_rois_per_this_image < rois_per_image:
-                labels_batch[i][fg_rois_per_this_image:] = 0
-
-            rois_batch[i] = all_rois[i][keep_inds]
-            rois_batch[i,:,0] = i
-
-            gt_rois_batch[i] = gt_boxes[i][gt_assignment[i][keep_inds]]
+        # Select foreground RoIs as those with >= FG_THRESH overlap, and background RoIs as those within
+        # [BG_THRESH_LO, BG_THRESH_HI)
+        fg_mask = max_overlaps >= self.FG_THRESH
+        bg_mask = (max_overlaps < self.BG_THRESH_HI) & (max_overlaps >= self.BG_THRESH_LO)
+        fg_num_rois = fg_mask.sum(1, keepdim=True)
+        bg_num_rois = bg_mask.sum(1, keepdim=True)
+
+        if ((fg_num_rois == 0) & (bg_num_rois == 0)).any():
+            raise ValueError("bg_num_rois = 0 and fg_num_rois = 0, this should not happen!")
+
+        # order the rois of each image by random keys: the fg in a random order, then the bg, then the rest
+        keys = torch.rand(max_overlaps.shape, device=max_overlaps.device) + 2 * fg_mask + bg_mask
+        order = keys.argsort(1, descending=True)
+
+        # the number of fg slots of each image, up to fg_rois_per_image (or all of them if there is no bg)
+        fg_rois_per_this_image = torch.where(bg_num_rois > 0,
+                                             fg_num_rois.clamp(max=fg_rois_per_image),
+                                             torch.full_like(fg_num_rois, rois_per_image))
+        slots = torch.arange(rois_per_image, device=order.device).view(1, -1)
+        is_fg = slots < fg_rois_per_this_image
+
+        # fg are sampled without replacement (the first of the random order) unless they fill the whole image, the bg
+        # fill the rest with replacement
+        draws = torch.rand((batch_size, rois_per_image), device=order.device)
+        fg_ranks = torch.where(bg_num_rois > 0, slots, (draws * fg_num_rois).long())
+        bg_ranks = fg_num_rois + (draws * bg_num_rois).long()
+        ranks = torch.where(is_fg, fg_ranks, bg_ranks).clamp(max=num_proposal - 1)
+
+        # The indices that we're selecting (both fg and bg)
+        keep_inds = order.gather(1, ranks)
+
+        # Select sampled values from various arrays, clamp labels for the background RoIs to 0
+        labels_batch = labels.gather(1, keep_inds).masked_fill(~is_fg, 0)
+
+        rois_batch = all_rois.gather(1, keep_inds.unsqueeze(2).expand(-1, -1, 5)).clone()
+        rois_batch[:, :, 0] = torch.arange(batch_size, device=rois_batch.device).view(-1, 1).type_as(rois_batch)
+
+        gt_inds = gt_assignment.gather(1, keep_inds)
+        gt_rois_batch = gt_boxes.gather(1, gt_inds.unsqueeze(2).expand(-1, -1, gt_boxes.size(2)))
 
         matches = labels_batch
         rois = rois_batch
@@ -201,22 +170,10 @@ class RCNNTargetGenerator(nn.Module):
             # Optionally normalize targets by a precomputed mean and stdev
             targets = ((targets - self.BBOX_NORMALIZE_MEANS.expand_as(targets)) / self.BBOX_NORMALIZE_STDS.expand_as(targets))
 
-        labels = labels.expand(1, -1)
-        batch_size = labels.size(0)
-        rois_per_image = labels.size(1)
-        clss = labels
-        bbox_targets = targets.new(batch_size, rois_per_image, 4).zero_()
-        bbox_inside_weights = targets.new(bbox_targets.size()).zero_()
-
-        for b in range(batch_size):
-            # assert clss[b].sum() > 0
-            if clss[b].sum() == 0:
-                continue
-            inds = torch.nonzero(clss[b] > 0).view(-1)
-            for i in range(inds.numel()):
-                ind = inds[i]
-                bbox_targets[b, ind, :] = targets[b, ind, :]
-                bbox_inside_weights[b, ind, :] = self.BBOX_INSIDE_WEIGHTS
+        # only the fg rois (label > 0) get regression targets
+        fg = (labels.view(targets.shape[:2]) > 0).unsqueeze(2)
+        bbox_targets = torch.where(fg, targets, torch.zeros_like(targets))
+        bbox_inside_weights = torch.where(fg, self.BBOX_INSIDE_WEIGHTS.expand_as(targets), torch.zeros_like(targets))
 
         bbox_outside_weights = (bbox_inside_weights > 0).float()
 
@@ -1,9 +1,18 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import torch  # Need this here so references correct torch imp
-from .nms import nms
+from .nms import nms, _C
 from .roi_align import ROIAlign
 from .roi_align import roi_align
 from .roi_pool import ROIPool
 from .roi_pool import roi_pool
+from . import torch_impl
 
-__all__ = ["nms", "roi_align", "ROIAlign", "roi_pool", "ROIPool"]
\ No newline at end of file
+# which implementation the layers use, the compiled extension, torchvision or pure pytorch
+if _C is not None:
+    backend = "_C"
+elif torch_impl.tv_ops is not None:
+    backend = "torchvision"
+else:
+    backend = "torch"
+
+__all__ = ["backend", "nms", "roi_align", "ROIAlign", "roi_pool", "ROIPool"]
\ No newline at end of file
@@ -0,0 +1,79 @@
+"""
+Benchmark the roi layer backends against each other: the compiled _C extension (if built), torchvision.ops (if
+installed) and the pure pytorch versions in torch_impl.
+
+python -m model_definitions.detectors.faster_rcnn.roi_layers.benchmark --device cpu
+"""
+import argparse
+import time
+
+import torch
+
+from . import torch_impl
+from .nms import _C
+
+
+def time_it(fn, repeats, device):
+    fn()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    since = time.time()
+    for _ in range(repeats):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - since) / repeats * 1000
+
+
+def random_boxes(n, size, device):
+    xy = torch.rand(n, 2, device=device) * size * .8
+    wh = torch.rand(n, 2, device=device) * size * .4 + 16
+    return torch.cat([xy, (xy + wh).clamp(max=size - 1)], 1)
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    # rpn sized nms (pre_nms_top_n boxes) and rcnn sized roi pooling (batch_size rois on a stride 16 feature map)
+    boxes = random_boxes(args.n_boxes, args.im_size, device)
+    scores = torch.rand(args.n_boxes, device=device)
+    feats = torch.randn(1, args.channels, args.im_size // 16, args.im_size // 16, device=device)
+    rois = torch.cat([torch.zeros(args.n_rois, 1, device=device), random_boxes(args.n_rois, args.im_size, device)], 1)
+
+    # use_torchvision=False so the torch backend times its own code even when torchvision is installed
+    backends = {'torch': {'nms': lambda: torch_impl.nms(boxes, scores, .7),
+                          'roi_align': lambda: torch_impl.roi_align(feats, rois, (7, 7), 1 / 16., 0,
+                                                                    use_torchvision=False),
+                          'roi_pool': lambda: torch_impl.roi_pool(feats, rois, (7, 7), 1 / 16., use_torchvision=False)}}
+
+    if torch_impl.tv_ops is not None:
+        tv_ops = torch_impl.tv_ops
+        # shift x2, y2 by one to match the +1 widths, (tv suppresses IoU > thresh rather than >=)
+        backends['torchvision'] = {'nms': lambda: tv_ops.nms(boxes + torch.tensor([0., 0., 1., 1.], device=device), scores, .7),
+                                   'roi_align': lambda: tv_ops.roi_align(feats, rois, (7, 7), 1 / 16., 0, aligned=False),
+                                   'roi_pool': lambda: tv_ops.roi_pool(feats, rois, (7, 7), 1 / 16.)}
+
+    if _C is not None:
+        backends['_C'] = {'nms': lambda: _C.nms(boxes, scores, .7),
+                          'roi_align': lambda: _C.roi_align_forward(feats, rois, 1 / 16., 7, 7, 0)}
+        if device.type == 'cuda':  # roi pool is cuda only
+            backends['_C']['roi_pool'] = lambda: _C.roi_pool_forward(feats, rois, 1 / 16., 7, 7)
+
+    print('{:12s} {:>12s} {:>12s} {:>12s}'.format('backend', 'nms ms', 'roi_align ms', 'roi_pool ms'))
+    for name, fns in backends.items():
+        times = ['{:12.2f}'.format(time_it(fns[op], args.repeats, device)) if op in fns else '{:>12s}'.format('-')
+                 for op in ['nms', 'roi_align', 'roi_pool']]
+        print('{:12s} {}'.format(name, ' '.join(times)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the roi layer backends')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--n_boxes', type=int, default=6000, help='number of boxes to nms, (rpn pre_nms_top_n)')
+    parser.add_argument('--n_rois', type=int, default=128, help='number of rois to pool, (rcnn batch_size)')
+    parser.add_argument('--im_size', type=int, default=600)
+    parser.add_argument('--channels', type=int, default=1024)
+    parser.add_argument('--repeats', type=int, default=10)
+
+    main(parser.parse_args())
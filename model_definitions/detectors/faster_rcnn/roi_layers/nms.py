@@ -1,8 +1,15 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 
 import torch  # Need this here so references correct torch imp
-from roi_layers import _C
 
-nms = _C.nms
+try:
+    from . import _C
+except ImportError:
+    _C = None  # not built, use the pure pytorch version
+
+if _C is not None:
+    nms = _C.nms
+else:
+    from .torch_impl import nms
 # nms.__doc__ = """
 # This function performs Non-maximum suppresion"""
\ No newline at end of file
@@ -5,7 +5,12 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.nn.modules.utils import _pair
 
-from roi_layers import _C
+from . import torch_impl
+
+try:
+    from . import _C
+except ImportError:
+    _C = None  # not built, use the pure pytorch version
 
 class _ROIAlign(Function):
     @staticmethod
@@ -41,7 +46,10 @@ class _ROIAlign(Function):
         return grad_input, None, None, None, None
 
 
-roi_align = _ROIAlign.apply
+if _C is not None:
+    roi_align = _ROIAlign.apply
+else:
+    roi_align = torch_impl.roi_align
 
 
 class ROIAlign(nn.Module):
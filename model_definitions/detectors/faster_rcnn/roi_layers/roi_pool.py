@@ -5,7 +5,12 @@ from torch.autograd import Function
 from torch.autograd.function import once_differentiable
 from torch.nn.modules.utils import _pair
 
-from roi_layers import _C
+from . import torch_impl
+
+try:
+    from . import _C
+except ImportError:
+    _C = None  # not built, use the pure pytorch version
 
 
 class _ROIPool(Function):
@@ -43,7 +48,10 @@ class _ROIPool(Function):
         return grad_input, None, None, None
 
 
-roi_pool = _ROIPool.apply
+if _C is not None:
+    roi_pool = _ROIPool.apply
+else:
+    roi_pool = torch_impl.roi_pool
 
 
 class ROIPool(nn.Module):
@@ -0,0 +1,209 @@
+"""
+Pure PyTorch versions of the roi layers, used when the compiled _C extension (faster_rcnn/setup.py) isn't built, so
+detection can run on cpu only machines.
+
+roi_align and roi_pool use torchvision.ops when it is installed, otherwise they are done in torch here. All follow the
+(legacy, non aligned) conventions of the compiled kernels: +1 box widths in nms and roi_pool, and no half pixel offset
+in roi_align.
+"""
+
+import torch
+from torch.nn.modules.utils import _pair
+
+try:
+    import torchvision.ops as tv_ops
+except ImportError:
+    tv_ops = None
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    IoU between two sets of (x1, y1, x2, y2) boxes, with the +1 widths of the compiled nms
+
+    :param boxes_a: N x 4
+    :param boxes_b: M x 4
+    :return: N x M IoUs
+    """
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0] + 1) * (boxes_a[:, 3] - boxes_a[:, 1] + 1)
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0] + 1) * (boxes_b[:, 3] - boxes_b[:, 1] + 1)
+
+    top_left = torch.max(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = torch.min(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    wh = (bottom_right - top_left + 1).clamp(min=0)
+    inter = wh[:, :, 0] * wh[:, :, 1]
+
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def nms(boxes, scores, thresh, block_size=1024):
+    """
+    Non-maximum suppression, suppressing boxes with IoU >= thresh with a higher scoring kept box
+
+    The boxes are processed highest score first in blocks: a block is first suppressed by the boxes kept from earlier
+    blocks, then within itself by iterating keep = no kept box above suppresses it, which reaches the greedy result in
+    as many steps as the longest chain of suppressions rather than one step per box.
+
+    :param boxes: N x 4 boxes (x1, y1, x2, y2)
+    :param scores: N scores
+    :param thresh: the IoU threshold
+    :param block_size: the number of boxes processed at once, bounds the IoU matrices to block_size x N
+    :return: the indexes of the kept boxes, highest score first
+    """
+    order = scores.argsort(descending=True)
+    boxes = boxes[order]
+
+    kept = torch.zeros(0, dtype=torch.long, device=boxes.device)
+    for start in range(0, len(boxes), block_size):
+        block = boxes[start:start + block_size]
+
+        # suppressed by a box kept from an earlier block
+        keep = torch.ones(len(block), dtype=torch.bool, device=boxes.device)
+        if len(kept):
+            keep = (box_iou(boxes[kept], block) < thresh).all(0)
+
+        # suppression within the block, only by higher scoring (earlier) boxes
+        suppresses = (box_iou(block, block) >= thresh).triu(1)
+        candidates = keep
+        while True:
+            new_keep = candidates & ~(suppresses & keep.unsqueeze(1)).any(0)
+            if torch.equal(new_keep, keep):
+                break
+            keep = new_keep
+
+        kept = torch.cat([kept, start + torch.nonzero(keep).view(-1)])
+
+    return order[kept]
+
+
+def _bilinear_weights(starts, bin_sizes, grids, n_bins, size):
+    """
+    The roi align sampling along one axis as a (R x n_bins x size) matrix, so pooling is a matmul on each side
+
+    :param starts: (R) start of each roi on the feature map
+    :param bin_sizes: (R) the size of a bin of each roi
+    :param grids: (R) the number of samples per bin of each roi
+    :param n_bins: the number of output bins
+    :param size: the size of the feature map along this axis
+    :return: (R x n_bins x size) weights, each bin averaging its bilinearly interpolated samples
+    """
+    n_rois = len(starts)
+    max_grid = int(grids.max()) if n_rois else 1
+    grids = grids.type_as(starts).view(-1, 1, 1)
+    samples = torch.arange(max_grid, device=starts.device).type_as(starts).view(1, 1, -1)
+    bins = torch.arange(n_bins, device=starts.device).type_as(starts).view(1, -1, 1)
+
+    # the sample coordinates, (R x n_bins x max_grid), samples past the grid of a roi get no weight
+    coords = starts.view(-1, 1, 1) + bins * bin_sizes.view(-1, 1, 1) + (samples + .5) * bin_sizes.view(-1, 1, 1) / grids
+    valid = (samples < grids) & (coords >= -1.0) & (coords <= size)
+
+    coords = coords.clamp(min=0)
+    low = coords.floor().long()
+    at_edge = low >= size - 1
+    low = low.clamp(max=size - 1)
+    high = torch.where(at_edge, low, low + 1)
+    coords = torch.where(at_edge, low.type_as(coords), coords)
+
+    frac = coords - low.type_as(coords)
+    scale = valid.type_as(coords) / grids
+
+    weights = starts.new_zeros((n_rois, n_bins, size))
+    weights.scatter_add_(2, low, (1 - frac) * scale)
+    weights.scatter_add_(2, high, frac * scale)
+    return weights
+
+
+def roi_align(input, rois, output_size, spatial_scale, sampling_ratio, use_torchvision=True):
+    """
+    ROIAlign, (N x C x H x W) features and (R x 5) rois of (batch index, x1, y1, x2, y2) to (R x C x out_h x out_w)
+
+    Bilinear sampling and averaging are separable, so each roi is two small weight matrices (along y and x) and
+    pooling is a pair of matmuls, differentiable with autograd.
+
+    :param use_torchvision: use torchvision.ops if it is installed
+    """
+    output_size = _pair(output_size)
+    if use_torchvision and tv_ops is not None:
+        return tv_ops.roi_align(input, rois, output_size, spatial_scale, sampling_ratio, aligned=False)
+
+    out_h, out_w = output_size
+    height, width = input.shape[2:]
+    rois = rois.type_as(input)
+
+    start_w, start_h = rois[:, 1] * spatial_scale, rois[:, 2] * spatial_scale
+    roi_w = (rois[:, 3] * spatial_scale - start_w).clamp(min=1)
+    roi_h = (rois[:, 4] * spatial_scale - start_h).clamp(min=1)
+    if sampling_ratio > 0:
+        grid_h = grid_w = torch.full_like(roi_h, sampling_ratio)
+    else:
+        grid_h, grid_w = torch.ceil(roi_h / out_h), torch.ceil(roi_w / out_w)
+
+    weights_y = _bilinear_weights(start_h, roi_h / out_h, grid_h, out_h, height)
+    weights_x = _bilinear_weights(start_w, roi_w / out_w, grid_w, out_w, width)
+
+    output = input.new_zeros((len(rois), input.size(1), out_h, out_w))
+    batch_inds = rois[:, 0].long()
+    for b in torch.unique(batch_inds).tolist():
+        inds = torch.nonzero(batch_inds == b).view(-1)
+        # (R_b x out_h x H) @ (C x H x W) @ (R_b x W x out_w)
+        pooled = torch.einsum('rph,chw->rcpw', weights_y[inds], input[b])
+        output[inds] = torch.einsum('rcpw,rqw->rcpq', pooled, weights_x[inds])
+
+    return output
+
+
+def roi_pool(input, rois, output_size, spatial_scale, use_torchvision=True, max_elements=2 ** 26):
+    """
+    ROIPool, (N x C x H x W) features and (R x 5) rois of (batch index, x1, y1, x2, y2) to (R x C x out_h x out_w)
+
+    The bin bounds of all the rois are computed at once, and each bin is a max over a window padded to the largest
+    bin, bins entirely off the map are 0. The rois are done in chunks of at most max_elements gathered values.
+
+    :param use_torchvision: use torchvision.ops if it is installed
+    :param max_elements: bounds the size of the gathered (rois x bins x window x C) values
+    """
+    output_size = _pair(output_size)
+    if use_torchvision and tv_ops is not None:
+        return tv_ops.roi_pool(input, rois, output_size, spatial_scale)
+
+    out_h, out_w = output_size
+    height, width = input.shape[2:]
+    if len(rois) == 0:
+        return input.new_zeros((0, input.size(1)) + output_size)
+
+    # rounded like the compiled kernel (half away from zero), rois are clipped so non negative
+    coords = torch.floor(rois[:, 1:].double() * spatial_scale + .5)
+    batch_inds = rois[:, 0].long()
+
+    def bin_bounds(start, end, n_bins, size):
+        # the [low, high) feature map range of each bin along one axis, (R x n_bins)
+        roi_size = (end - start + 1).clamp(min=1)
+        bins = torch.arange(n_bins, device=rois.device, dtype=torch.double)
+        bin_size = roi_size.view(-1, 1) / n_bins
+        low = (torch.floor(bins * bin_size) + start.view(-1, 1)).clamp(0, size).long()
+        high = (torch.ceil((bins + 1) * bin_size) + start.view(-1, 1)).clamp(0, size).long()
+        return low, high
+
+    low_y, high_y = bin_bounds(coords[:, 1], coords[:, 3], out_h, height)
+    low_x, high_x = bin_bounds(coords[:, 0], coords[:, 2], out_w, width)
+
+    # each bin's window padded to the largest bin by repeating its last index (which leaves the max unchanged),
+    # (R x out_h x kh) and (R x out_w x kw)
+    kh, kw = [max(int(k), 1) for k in torch.stack([(high_y - low_y).max(), (high_x - low_x).max()]).tolist()]
+    ys = torch.min(low_y.unsqueeze(2) + torch.arange(kh, device=rois.device), (high_y - 1).clamp(min=0).unsqueeze(2))
+    xs = torch.min(low_x.unsqueeze(2) + torch.arange(kw, device=rois.device), (high_x - 1).clamp(min=0).unsqueeze(2))
+    ys, xs = ys.clamp(max=height - 1), xs.clamp(max=width - 1)
+    empty = (high_y <= low_y).unsqueeze(2) | (high_x <= low_x).unsqueeze(1)
+
+    # gather whole channel vectors, (N x H x W x C)
+    features = input.permute(0, 2, 3, 1)
+
+    outputs = []
+    chunk = max(max_elements // (input.size(1) * out_h * out_w * kh * kw), 1)
+    for start in range(0, len(rois), chunk):
+        r = slice(start, start + chunk)
+        # (R x out_h x out_w x kh x kw x C)
+        values = features[batch_inds[r].view(-1, 1, 1, 1, 1), ys[r][:, :, None, :, None], xs[r][:, None, :, None, :]]
+        outputs.append(values.amax(dim=(3, 4)).permute(0, 3, 1, 2))
+
+    output = torch.cat(outputs)
+    return output.masked_fill(empty.unsqueeze(1), 0)
@@ -7,7 +7,10 @@
 # Modified by Hayden Faulkner
 # --------------------------------------------------------
 
+from collections import OrderedDict
+
 import numpy as np
+import torch
 
 
 def generate_anchors(stride, base_size, ratios, scales, feat_size):
@@ -74,3 +77,79 @@ def shift_anchor_bases(anchor_bases,stride, feat_size):
 
     return anchors
 
+
+
+class AnchorCache(object):
+    """
+    LRU cache of the shifted anchors (on device) for a feature map size, so they are generated in numpy and copied over
+    once rather than every forward. Shared by RPNProposal and RPNTargetSampler through anchor_cache below.
+    """
+
+    def __init__(self, max_size=16):
+        """
+        :param max_size: the max number of anchor grids kept, the least recently used is evicted past this
+        """
+        super(AnchorCache, self).__init__()
+
+        self.max_size = max_size
+        self.entries = OrderedDict()  # key > {'anchors', 'inside'}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, anchor_bases, stride, feat_size, device, dtype):
+        """
+        The anchors shifted across a feature map
+
+        :param anchor_bases: (A x 4) numpy array of anchor bases
+        :param stride: the stride of the feature map
+        :param feat_size: (height, width) of the feature map
+        :param device: the device to put the anchors on
+        :param dtype: the type of the anchors
+        :return: (1 x H*W*A x 4) tensor of anchors, the same tensor while it is cached
+        """
+        key = (int(feat_size[0]), int(feat_size[1]), stride, torch.device(device), dtype, anchor_bases.tobytes())
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]['anchors']
+
+        anchors = shift_anchor_bases(anchor_bases, stride, feat_size)
+        anchors = torch.from_numpy(anchors).to(device=device, dtype=dtype)
+        self.entries[key] = {'anchors': anchors, 'inside': {}}
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return anchors
+
+    def get_inside(self, anchors, img_height, img_width, allowed_border=0):
+        """
+        The indexes of the anchors inside an image (plus allowed_border), cached with the anchors if they came from get
+
+        :param anchors: (1 x N x 4) tensor of anchors
+        :param img_height: the image height
+        :param img_width: the image width
+        :param allowed_border: how far boxes can sit over the edge
+        :return: (n_inside) tensor of anchor indexes
+        """
+        inside_key = (img_height, img_width, allowed_border)
+        entry = None
+        for e in reversed(self.entries.values()):
+            if e['anchors'] is anchors:
+                entry = e
+                break
+        if entry is not None and inside_key in entry['inside']:
+            return entry['inside'][inside_key]
+
+        anchors = anchors[0]
+        keep = ((anchors[:, 0] >= -allowed_border) &
+                (anchors[:, 1] >= -allowed_border) &
+                (anchors[:, 2] < img_width + allowed_border) &
+                (anchors[:, 3] < img_height + allowed_border))
+        inds_inside = torch.nonzero(keep).view(-1)
+
+        if entry is not None:
+            entry['inside'][inside_key] = inds_inside
+        return inds_inside
+
+
+anchor_cache = AnchorCache()
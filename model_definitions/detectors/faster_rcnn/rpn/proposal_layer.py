@@ -15,9 +15,9 @@ import torch
 import torch.nn as nn
 
 from ..bbox_transform import bbox_transform_inv, clip_boxes  #, clip_boxes_batch
-from .generate_anchors import shift_anchor_bases
+from .generate_anchors import anchor_cache
 
-from roi_layers import nms
+from ..roi_layers import nms
 
 
 class RPNProposal(nn.Module):
@@ -72,8 +72,8 @@ class RPNProposal(nn.Module):
 
         batch_size = bbox_deltas.size(0)
 
-        anchors = shift_anchor_bases(self._anchor_bases, self._stride, (scores.size(2), scores.size(3)))
-        anchors = torch.from_numpy(anchors).type_as(scores)
+        anchors = anchor_cache.get(self._anchor_bases, self._stride, (scores.size(2), scores.size(3)),
+                                   scores.device, scores.dtype)
 
         # Transpose and reshape predicted bbox transformations to get them
         # into the same order as the anchors:
@@ -91,58 +91,45 @@ class RPNProposal(nn.Module):
         proposals = clip_boxes(proposals, im_info, batch_size)  # clipper in gluoncv (l68rpn/proposal.py)
         # proposals = clip_boxes_batch(proposals, im_info, batch_size)
 
-        # assign the score to 0 if it's non keep.
-        # keep = self._filter_boxes(proposals, min_size * im_info[:, 2])
-
-        # trim keep index to make it equal over batch
-        # keep_idx = torch.cat(tuple(keep_idx), 0)
-
-        # scores_keep = scores.view(-1)[keep_idx].view(batch_size, trim_size)
-        # proposals_keep = proposals.view(-1, 4)[keep_idx, :].contiguous().view(batch_size, trim_size, 4)
-
-        # _, order = torch.sort(scores_keep, 1, True)
-
-        scores_keep = scores
-        proposals_keep = proposals
-        _, order = torch.sort(scores_keep, 1, True)
+        # 3. remove predicted boxes with either height or width < threshold
+        # (NOTE: convert min_size to input image scale stored in im_info[2])
+        keep = self._filter_boxes(proposals, min_size * im_info[:, 2])
+        scores = scores.masked_fill(~keep, -1)  # scores are probs, so removed boxes come last
+
+        # 4. sort all (proposal, score) pairs by score from highest to lowest
+        # 5. take top pre_nms_topN (e.g. 6000)
+        num_pre = scores.size(1) if pre_nms_topN <= 0 else min(pre_nms_topN, scores.size(1))
+        scores_top, order = scores.topk(num_pre, dim=1)
+        proposals_top = proposals.gather(1, order.unsqueeze(2).expand(-1, -1, 4))
+
+        # 6. apply nms (e.g. threshold = 0.7) to every image in a single call, the boxes of each image are offset
+        # so boxes of different images never overlap
+        flat_inds = torch.nonzero(scores_top.view(-1) >= 0).view(-1)
+        boxes = proposals_top.view(-1, 4)[flat_inds]
+        offsets = (flat_inds // num_pre).type_as(boxes) * (boxes.max() + 1 if len(boxes) else 0)
+        keep_idx = nms(boxes + offsets.view(-1, 1), scores_top.view(-1)[flat_inds], nms_thresh).long().view(-1)
+
+        # the flat index is image * num_pre + score rank, so sorting groups the kept boxes by image in score order
+        keep_idx, _ = flat_inds[keep_idx].sort()
+        image_idx = keep_idx // num_pre
+        counts = torch.bincount(image_idx, minlength=batch_size)
+        rank = torch.arange(len(keep_idx), device=keep_idx.device) - (torch.cumsum(counts, 0) - counts)[image_idx]
+
+        # 7. take after_nms_topN (e.g. 300)
+        if post_nms_topN > 0:
+            keep_post = rank < post_nms_topN
+            keep_idx, image_idx, rank = keep_idx[keep_post], image_idx[keep_post], rank[keep_post]
+
+        # 8. return the top proposals (-> RoIs top), padding 0 at the end
+        image_ids = torch.arange(batch_size, device=scores.device).type_as(scores).view(-1, 1)
 
         rpn_scores = scores.new(batch_size, post_nms_topN, 1).zero_()
+        rpn_scores[:, :, 0] = image_ids  # first item is the batch index
+        rpn_scores[image_idx, rank, 0] = scores_top.view(-1)[keep_idx]
+
         rpn_bbox = scores.new(batch_size, post_nms_topN, 5).zero_()
-        for i in range(batch_size):
-            # # 3. remove predicted boxes with either height or width < threshold
-            # # (NOTE: convert min_size to input image scale stored in im_info[2])
-            proposals_single = proposals_keep[i]
-            scores_single = scores_keep[i]
-
-            # # 4. sort all (proposal, score) pairs by score from highest to lowest
-            # # 5. take top pre_nms_topN (e.g. 6000)
-            order_single = order[i]
-
-            if 0 < pre_nms_topN < scores_keep.numel():
-                order_single = order_single[:pre_nms_topN]
-
-            proposals_single = proposals_single[order_single, :]
-            scores_single = scores_single[order_single].view(-1,1)
-
-            # 6. apply nms (e.g. threshold = 0.7)
-            # 7. take after_nms_topN (e.g. 300)
-            # 8. return the top proposals (-> RoIs top)
-            keep_idx_i = nms(proposals_single, scores_single.squeeze(1), nms_thresh)
-            keep_idx_i = keep_idx_i.long().view(-1)
-
-            if post_nms_topN > 0:
-                keep_idx_i = keep_idx_i[:post_nms_topN]
-            proposals_single = proposals_single[keep_idx_i, :]
-            scores_single = scores_single[keep_idx_i, :]
-
-            num_proposal = proposals_single.size(0)
-            rpn_scores[i, :, 0] = i  # first item is the batch index
-            rpn_scores[i, :num_proposal, :] = scores_single
-
-            # padding 0 at the end.
-            # num_proposal = proposals_single.size(0)
-            rpn_bbox[i, :, 0] = i
-            rpn_bbox[i, :num_proposal, 1:] = proposals_single
+        rpn_bbox[:, :, 0] = image_ids
+        rpn_bbox[image_idx, rank, 1:] = proposals_top.view(-1, 4)[keep_idx]
 
         return rpn_scores, rpn_bbox, anchors
 
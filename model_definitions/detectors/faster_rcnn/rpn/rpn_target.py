@@ -14,9 +14,9 @@
 
 import torch
 import torch.nn as nn
-import numpy as np
 
 from ..bbox_transform import clip_boxes, bbox_overlaps_batch, bbox_transform_batch
+from .generate_anchors import anchor_cache
 
 
 class RPNTargetSampler(nn.Module):
@@ -60,17 +60,12 @@ class RPNTargetSampler(nn.Module):
         #   apply predicted bbox deltas at cell i to each of the 9 anchors
 
         batch_size = gt_boxes.size(0)
-        anchors = anchors[0]  # removing batch axis
         # filter out-of-image anchors
         img_width = int(im_info[0][1])
         img_height = int(im_info[0][0])
-        keep = ((anchors[:, 0] >= -self._allowed_border) &
-                (anchors[:, 1] >= -self._allowed_border) &
-                (anchors[:, 2] < img_width + self._allowed_border) &
-                (anchors[:, 3] < img_height + self._allowed_border))
-
-        inds_inside = torch.nonzero(keep).view(-1)
+        inds_inside = anchor_cache.get_inside(anchors, img_height, img_width, self._allowed_border)
 
+        anchors = anchors[0]  # removing batch axis
         anchors = anchors[inds_inside, :]
 
         # label: 1 is positive, 0 is negative, -1 is dont care
@@ -99,32 +94,12 @@ class RPNTargetSampler(nn.Module):
 
         num_fg = int(self.RPN_FG_FRACTION * self.RPN_BATCHSIZE)
 
-        sum_fg = torch.sum((labels == 1).int(), 1)
-        sum_bg = torch.sum((labels == 0).int(), 1)
-
-        for i in range(batch_size):
-            # subsample positive labels if we have too many
-            if sum_fg[i] > num_fg:
-                fg_inds = torch.nonzero(labels[i] == 1).view(-1)
-                # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-                # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-                # use numpy instead.
-                #rand_num = torch.randperm(fg_inds.size(0)).type_as(gt_boxes).long()
-                rand_num = torch.from_numpy(np.random.permutation(fg_inds.size(0))).type_as(gt_boxes).long()
-                disable_inds = fg_inds[rand_num[:fg_inds.size(0)-num_fg]]
-                labels[i][disable_inds] = -1
-
-#           num_bg = cfg.TRAIN.RPN_BATCHSIZE - sum_fg[i]
-            num_bg = self.RPN_BATCHSIZE - torch.sum((labels == 1).int(), 1)[i]
-
-            # subsample negative labels if we have too many
-            if sum_bg[i] > num_bg:
-                bg_inds = torch.nonzero(labels[i] == 0).view(-1)
-                #rand_num = torch.randperm(bg_inds.size(0)).type_as(gt_boxes).long()
-
-                rand_num = torch.from_numpy(np.random.permutation(bg_inds.size(0))).type_as(gt_boxes).long()
-                disable_inds = bg_inds[rand_num[:bg_inds.size(0)-num_bg]]
-                labels[i][disable_inds] = -1
+        # subsample positive labels if we have too many, then negatives to fill the rest of the batch
+        # done for all images at once, with random keys and a topk instead of a permutation per image
+        max_keep = min(self.RPN_BATCHSIZE, labels.size(1))
+        _subsample(labels, 1, labels.new_full((batch_size,), num_fg), max_keep)
+        num_bg = self.RPN_BATCHSIZE - torch.sum((labels == 1).int(), 1)
+        _subsample(labels, 0, num_bg, max_keep)
 
         offset = torch.arange(0, batch_size)*gt_boxes.size(1)
 
@@ -218,6 +193,30 @@ class RPNTargetGenerator(nn.Module):
         pass
 
 
+def _subsample(labels, value, num_keep, max_keep):
+    """
+    Randomly disable (set to -1) the labels equal to value, so at most num_keep of them are left in each image
+
+    :param labels: (batch_size x n_anchors) labels, modified in place
+    :param value: the label to subsample, 1 for fg and 0 for bg
+    :param num_keep: (batch_size) tensor, the max number of the labels to keep in each image
+    :param max_keep: an upper bound on num_keep (and <= n_anchors)
+    :return: labels
+    """
+    candidates = labels == value
+
+    # the candidates with the max_keep highest random keys of each image, in order
+    keys = torch.rand(labels.shape, device=labels.device).masked_fill_(~candidates, -1)
+    _, top = keys.topk(max_keep, dim=1)
+
+    # keep the j-th highest if j < num_keep of its image
+    keep_top = torch.arange(max_keep, device=labels.device).unsqueeze(0) < num_keep.view(-1, 1)
+    keep = torch.zeros_like(candidates).scatter_(1, top, keep_top)
+    labels[candidates & ~keep] = -1
+
+    return labels
+
+
 def _unmap(data, count, inds, batch_size, fill=0):
     """ Unmap a subset of item (data) back to the original set of items (of
     size count) """
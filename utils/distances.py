@@ -0,0 +1,50 @@
+"""
+Pairwise distances between two sets of vectors.
+
+Both use a matmul rather than broadcasting to an (N x M x D) tensor, so the only (N x M) sized memory is the output.
+chunk_size splits y into blocks of rows to bound the temporaries further when M is huge (eg. many representatives).
+"""
+import torch
+import torch.nn.functional as F
+
+
+def euclidean_distance(x, y, chunk_size=None):
+    '''
+    Compute the squared euclidean distance between two tensors as ||x||^2 + ||y||^2 - 2xy^T
+
+    :param x: N x D
+    :param y: M x D
+    :param chunk_size: if given compute the distances to this many rows of y at a time
+    :return: N x M squared distances
+    '''
+    if x.size(1) != y.size(1):
+        raise Exception("size mismatch")
+
+    x_sq = (x ** 2).sum(1, keepdim=True)
+    if chunk_size is None or chunk_size >= y.size(0):
+        return _euclidean_distance(x, x_sq, y)
+    return torch.cat([_euclidean_distance(x, x_sq, y_chunk) for y_chunk in torch.split(y, chunk_size)], dim=1)
+
+
+def _euclidean_distance(x, x_sq, y):
+    dists = torch.addmm(x_sq + (y ** 2).sum(1).unsqueeze(0), x, y.t(), alpha=-2)
+    return dists.clamp(min=0)  # rounding can make distances of (near) identical vectors negative
+
+
+def cosine_distance(x, y, chunk_size=None):
+    '''
+    Compute the cosine distance (1 - cosine similarity, range of 0 - 2) between two tensors
+
+    :param x: N x D
+    :param y: M x D
+    :param chunk_size: if given compute the distances to this many rows of y at a time
+    :return: N x M cosine distances
+    '''
+    if x.size(1) != y.size(1):
+        raise Exception("size mismatch")
+
+    x = F.normalize(x, dim=1)
+    y = F.normalize(y, dim=1)
+    if chunk_size is None or chunk_size >= y.size(0):
+        return 1 - torch.mm(x, y.t())
+    return torch.cat([1 - torch.mm(x, y_chunk.t()) for y_chunk in torch.split(y, chunk_size)], dim=1)
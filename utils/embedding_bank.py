@@ -0,0 +1,65 @@
+"""
+EmbeddingBank: a preallocated store of the embeddings of every sample in a dataset, indexed by dataset position.
+
+Rows are written in place (so embedding an entire dataset never holds more than one copy of it) and each row keeps
+a stamp of when it was last written (eg. the training step), so stale rows can be found and refreshed on their own.
+The array can optionally be memory-mapped to a file for datasets too large to keep in RAM.
+"""
+import numpy as np
+
+
+class EmbeddingBank(object):
+
+    def __init__(self, n_samples, emb_size=None, dtype='float32', path=None):
+        """
+        :param n_samples: the number of samples in the dataset
+        :param emb_size: the size of the embeddings, if None the bank is allocated on the first update
+        :param dtype: the storage type of the embeddings, float16 halves the memory
+        :param path: if given the embeddings are memory-mapped to this file rather than kept in memory
+        """
+        super(EmbeddingBank, self).__init__()
+
+        self.n_samples = n_samples
+        self.dtype = np.dtype(dtype)
+        self.path = path
+
+        self.embeddings = None
+        self.labels = np.zeros(n_samples, dtype=np.int64)
+        self.stamps = np.full(n_samples, -1, dtype=np.int64)  # -1 never embedded
+
+        if emb_size is not None:
+            self.allocate(emb_size)
+
+    def __len__(self):
+        return self.n_samples
+
+    def allocate(self, emb_size):
+        if self.path is not None:
+            self.embeddings = np.memmap(self.path, dtype=self.dtype, mode='w+', shape=(self.n_samples, emb_size))
+        else:
+            self.embeddings = np.zeros((self.n_samples, emb_size), dtype=self.dtype)
+
+    def update(self, indexes, embeddings, labels=None, stamp=0):
+        """
+        Write the embeddings (and labels) of the samples at indexes
+
+        :param indexes: the dataset positions of the samples, or a slice
+        :param embeddings: (n x emb_size) array of embeddings
+        :param labels: optional (n) array of labels
+        :param stamp: when these were embedded (eg. the training step)
+        """
+        if self.embeddings is None:
+            self.allocate(embeddings.shape[1])
+
+        self.embeddings[indexes] = embeddings
+        if labels is not None:
+            self.labels[indexes] = labels
+        self.stamps[indexes] = stamp
+
+    def embedded(self):
+        """Indexes of the samples that have been embedded at least once"""
+        return np.flatnonzero(self.stamps >= 0)
+
+    def stale(self, stamp):
+        """Indexes of the samples last embedded before stamp (including those never embedded)"""
+        return np.flatnonzero(self.stamps < stamp)
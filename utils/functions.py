@@ -1,6 +1,8 @@
 import torch
 import torch.nn.functional as F
 
+from utils.distances import euclidean_distance, cosine_distance  # kept importable from here
+
 
 def expand_dims(var, dim=0):
     """ Is similar to [numpy.expand_dims](https://docs.scipy.org/doc/numpy/reference/generated/numpy.expand_dims.html).
@@ -36,36 +38,6 @@ def make_one_hot(labels, n_classes):
     return one_hot.scatter_(1, torch.unsqueeze(labels, 1).long().cpu(), 1).byte()
 
 
-def euclidean_distance(x, y):
-    '''
-    Compute euclidean distance between two tensors
-    '''
-    # x: N x D
-    # y: M x D
-    n = x.size(0)
-    m = y.size(0)
-    d = x.size(1)
-    if d != y.size(1):
-        raise Exception("size mismatch")
-
-    x = x.unsqueeze(1).expand(n, m, d)
-    y = y.unsqueeze(0).expand(n, m, d)
-
-    return torch.pow(x - y, 2).sum(2)
-
-
-def cosine_distance(x, y):
-    # x: N x D
-    # y: M x D
-    d = x.size(1)
-    if d != y.size(1):
-        raise Exception("size mismatch")
-
-    x = x.transpose(0, 1).unsqueeze(0)
-    y = y.unsqueeze(2)
-    return - (F.cosine_similarity(y, x)-1).transpose(0, 1)  # (range of 0 - 2)
-
-
 def _smooth_l1_loss(bbox_pred, bbox_targets, bbox_inside_weights, bbox_outside_weights, sigma=1.0, dim=[1]):
 
     # used in rpn.rpn and faster_rcnn
@@ -0,0 +1,108 @@
+"""
+Batched per-class k-means
+
+Runs k-means for every class at once on padded (n_classes x max_per_class x D) tensors, rather than looping over the
+classes and fitting a sklearn KMeans for each. Used to build the magnet clusters and the repmet representatives.
+"""
+import torch
+
+device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+def pad_by_class(data, labels, n_classes):
+    """
+    Arrange the examples into a padded tensor with a row per class
+
+    :param data: (N x D) tensor of examples
+    :param labels: (N) long tensor of class labels in [0, n_classes)
+    :param n_classes: the number of classes
+    :return: the (n_classes x max_per_class x D) padded data, the (n_classes x max_per_class) mask of valid entries
+             and the (N) class-row position of each example
+    """
+    counts = torch.bincount(labels, minlength=n_classes)
+    offsets = torch.cumsum(counts, 0) - counts
+
+    order = torch.argsort(labels, stable=True)
+    sorted_labels = labels[order]
+    positions = torch.empty_like(labels)
+    positions[order] = torch.arange(len(labels), device=labels.device) - offsets[sorted_labels]
+
+    max_per_class = max(int(counts.max().item()), 1)
+    padded = data.new_zeros((n_classes, max_per_class, data.size(1)))
+    padded[labels, positions] = data
+    mask = torch.zeros((n_classes, max_per_class), dtype=torch.bool, device=data.device)
+    mask[labels, positions] = True
+
+    return padded, mask, positions
+
+
+def squared_distances(padded, centroids):
+    """(n_classes x max_per_class x k) squared distances from each example to the centroids of its class"""
+    dists = torch.baddbmm((centroids ** 2).sum(2).unsqueeze(1), padded, centroids.transpose(1, 2), alpha=-2)
+    return (dists + (padded ** 2).sum(2, keepdim=True)).clamp_(min=0)
+
+
+def kmeans_plus_plus(padded, mask, k):
+    """k-means++ seeding done for all classes at once"""
+    n_classes = padded.size(0)
+    rows = torch.arange(n_classes, device=padded.device)
+
+    # first centroid is a random (valid) example of each class
+    chosen = (torch.rand(mask.shape, device=padded.device) * mask).argmax(1)
+    centroids = [padded[rows, chosen]]
+    min_dists = squared_distances(padded, centroids[0].unsqueeze(1)).squeeze(2)
+
+    # classes with no examples just repeat the zero padding
+    empty = (~mask.any(1, keepdim=True)).type_as(padded)
+
+    for _ in range(1, k):
+        # sample the next centroid proportional to the squared distance from the closest chosen centroid,
+        # a small weight on every valid example keeps classes of identical examples sampleable
+        weights = (min_dists + 1e-12) * mask + empty
+        chosen = torch.multinomial(weights, 1).squeeze(1)
+        centroids.append(padded[rows, chosen])
+        min_dists = torch.min(min_dists, squared_distances(padded, centroids[-1].unsqueeze(1)).squeeze(2))
+
+    return torch.stack(centroids, 1)
+
+
+def batched_kmeans(data, labels, n_classes, k, init_centroids=None, max_iter=20):
+    """
+    Run k-means with k clusters for every class at once
+
+    :param data: (N x D) array or tensor of examples
+    :param labels: (N) array or tensor of class labels in [0, n_classes)
+    :param n_classes: the number of classes
+    :param k: the number of clusters per class
+    :param init_centroids: optional (n_classes*k x D) centroids to warm start from, otherwise seeded with k-means++
+    :param max_iter: the maximum number of iterations
+    :return: the (n_classes*k x D) centroids and the (N) global cluster index (class*k + cluster) of each example
+             as numpy arrays
+    """
+    data = torch.as_tensor(data, dtype=torch.float, device=device)
+    labels = torch.as_tensor(labels, dtype=torch.long, device=device)
+
+    padded, mask, positions = pad_by_class(data, labels, n_classes)
+
+    if init_centroids is not None:
+        centroids = torch.as_tensor(init_centroids, dtype=torch.float, device=device).view(n_classes, k, -1).clone()
+    else:
+        centroids = kmeans_plus_plus(padded, mask, k)
+
+    assignments = None
+    for _ in range(max_iter):
+        new_assignments = squared_distances(padded, centroids).argmin(2)
+        if assignments is not None and torch.equal(new_assignments[mask], assignments[mask]):
+            break
+        assignments = new_assignments
+
+        # recompute the means, clusters which lost all their examples keep their previous centroid
+        one_hot = torch.nn.functional.one_hot(assignments, k).type_as(padded) * mask.unsqueeze(2)
+        sums = torch.bmm(one_hot.transpose(1, 2), padded)
+        counts = one_hot.sum(1).unsqueeze(2)
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+
+    assignments = squared_distances(padded, centroids).argmin(2)
+    example_assignments = labels * k + assignments[labels, positions]
+
+    return centroids.view(n_classes * k, -1).cpu().numpy(), example_assignments.cpu().numpy()
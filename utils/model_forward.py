@@ -1,29 +1,106 @@
-
-from math import ceil
+import time
 
 import numpy as np
 
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
+
+from utils.embedding_bank import EmbeddingBank
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-def forward(model, dataset, batch_size):
-    """Compute representations for input in chunks."""
-    chunks = int(ceil(float(len(dataset)) / batch_size))
-    outputs = []
-    labels = []
+def forward(model, dataset, batch_size, bank=None, indexes=None, stamp=0,
+            num_workers=1, pin_memory=False, prefetch_factor=2, amp=False, channels_last=False):
+    """
+    Compute representations for input in chunks, writing them straight into an EmbeddingBank
+
+    :param model: the model to embed with
+    :param dataset: the dataset to embed
+    :param batch_size: the batch size of the forward passes
+    :param bank: the EmbeddingBank to write to, a temporary one is made if None
+    :param indexes: only (re)embed the samples at these dataset positions, all if None
+    :param stamp: the stamp to give the embedded rows in the bank (eg. the training step)
+    :param num_workers: the number of data loading workers
+    :param pin_memory: load batches into pinned memory so host to device copies can be asynchronous
+    :param prefetch_factor: the number of batches each worker loads ahead
+    :param amp: run the model under autocast (mixed precision)
+    :param channels_last: convert the model (if it isn't already, it's left so) and its inputs to the channels last
+                          memory format
+    :return: the embeddings and labels of the entire dataset (views into the bank)
+    """
+    if bank is None:
+        bank = EmbeddingBank(len(dataset))
+    if indexes is None:
+        indexes = np.arange(len(dataset))
+    else:
+        dataset = Subset(dataset, indexes)
+
+    was_training = model.training
     model.eval()
+
+    # the weights have to be channels last too, or the convolutions convert the inputs back. Only converted when they
+    # aren't already, and not converted back, so repeated passes don't each copy the weights twice
+    if channels_last:
+        weights = [p for p in model.parameters() if p.dim() == 4]
+        if weights and not weights[0].is_contiguous(memory_format=torch.channels_last):
+            model.to(memory_format=torch.channels_last)
     loader = DataLoader(dataset,
                         batch_size=batch_size,  #chunks,
                         shuffle=False,  # don't shuffle as we take labels in order in cluster update
-                        num_workers=1)
+                        num_workers=num_workers,
+                        pin_memory=pin_memory and device.type == 'cuda',
+                        prefetch_factor=prefetch_factor if num_workers > 0 else None)
+
+    asynchronous = device.type == 'cuda'
+
+    # two pinned host buffers the outputs are copied back into, alternating, so a batch's copy can overlap with the
+    # write of the one before. Allocated once at the size of a full batch, pinning memory is slow
+    staging = [None, None]
+    events = [None, None]
 
+    def write(pending):
+        # wait for the device to host copy of a batch and store it
+        outs, event, start, labels_ = pending
+        if event is not None:
+            event.synchronize()
+        bank.update(indexes[start:start + len(outs)], outs.numpy(), labels=labels_.numpy(), stamp=stamp)
+
+    since = time.time()
+    start = 0
+    pending = None
     with torch.no_grad():  # prevents computation graph from being made
         for batch_idx, (inputs, labels_) in enumerate(loader):
-            inputs = inputs.to(device)
-            output = model(inputs)
-            outs = output.data
-            outputs.append(outs.cpu().numpy())
-            labels.append(labels_.cpu().numpy())
-    return np.vstack(outputs), np.hstack(labels)
+            inputs = inputs.to(device, non_blocking=asynchronous)
+            if channels_last and inputs.dim() == 4:
+                inputs = inputs.contiguous(memory_format=torch.channels_last)
+            with torch.autocast(device_type=device.type, enabled=amp):
+                output = model(inputs)
+
+            if asynchronous:
+                # copy the outputs back while the next batch is being computed, the bank write waits on the event
+                slot = batch_idx % 2
+                if staging[slot] is None:
+                    staging[slot] = torch.empty((batch_size,) + output.shape[1:], dtype=torch.float, pin_memory=True)
+                elif events[slot] is not None:
+                    events[slot].synchronize()  # the last copy into this buffer is done before it's overwritten
+                outs = staging[slot][:len(output)]
+                outs.copy_(output, non_blocking=True)
+                event = events[slot] = torch.cuda.Event()
+                event.record()
+            else:
+                outs = output.float()
+                event = None
+
+            if pending is not None:
+                write(pending)
+            pending = (outs, event, start, labels_)
+            start += len(outs)
+
+        if pending is not None:
+            write(pending)
+
+    time_elapsed = time.time() - since
+    print('Embedded {} images in {:.1f}s ({:.1f} images/sec)'.format(start, time_elapsed, start / max(time_elapsed, 1e-8)))
+
+    model.train(was_training)
+    return bank.embeddings, bank.labels
@@ -0,0 +1,119 @@
+"""
+RepIndex: an approximate nearest representative index (inverted file, IVF) in pure torch.
+
+The representatives are clustered into n_lists coarse lists with k-means. A search only compares an embedding to the
+representatives in its n_probe closest lists, then returns the top L of those. With thousands of classes this avoids
+computing the distance from every embedding to every representative, so classification and detection heads can score
+just the candidates.
+"""
+import numpy as np
+
+import torch
+
+from utils.distances import euclidean_distance
+from utils.kmeans import batched_kmeans
+
+
+class RepIndex(object):
+
+    def __init__(self, n_lists=64, n_probe=8, dist='euc'):
+        """
+        :param n_lists: the number of coarse lists (clusters) the representatives are split into
+        :param n_probe: the number of closest lists searched per embedding
+        :param dist: 'euc' or 'cos', the distance the candidates are ranked with
+        """
+        super(RepIndex, self).__init__()
+
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.dist = dist
+
+        self.reps = None
+        self.reps_sq = None
+        self.list_centroids = None
+        self.lists = None  # (n_lists x max_list_size) rep indexes, padded with -1
+        self.list_reps = None  # the (list_size x D) reps of each list, and their squared norms
+        self.list_sq = None
+
+    def build(self, reps, valid=None):
+        """
+        (Re)build the index over a set of representatives
+
+        :param reps: (n_reps x D) tensor of representatives
+        :param valid: optional (n_reps) bool tensor, only these reps are indexed (the returned indexes are still into reps)
+        """
+        self.reps = reps.detach()
+        if self.dist == 'cos':
+            self.reps = torch.nn.functional.normalize(self.reps, dim=1)
+        self.reps_sq = (self.reps ** 2).sum(1)
+
+        if valid is None:
+            rep_idxs = torch.arange(len(self.reps), device=self.reps.device)
+        else:
+            rep_idxs = torch.nonzero(valid.to(self.reps.device)).squeeze(1)
+        n_lists = max(min(self.n_lists, len(rep_idxs)), 1)
+
+        centroids, assignments = batched_kmeans(self.reps[rep_idxs], np.zeros(len(rep_idxs), dtype=np.int64), 1, n_lists)
+        self.list_centroids = torch.as_tensor(centroids, device=self.reps.device)
+        assignments = torch.as_tensor(assignments, device=self.reps.device)
+
+        # pad the lists into a (n_lists x max_list_size) table
+        sizes = torch.bincount(assignments, minlength=n_lists)
+        order = torch.argsort(assignments, stable=True)
+        positions = torch.arange(len(order), device=order.device) - (torch.cumsum(sizes, 0) - sizes)[assignments[order]]
+        self.lists = torch.full((n_lists, int(sizes.max())), -1, dtype=torch.long, device=self.reps.device)
+        self.lists[assignments[order], positions] = rep_idxs[order]
+
+        # each list's reps stored together, so a search multiplies against them without gathering reps per embedding
+        members = torch.split(rep_idxs[order], sizes.tolist())
+        self.list_reps = [self.reps[m] for m in members]
+        self.list_sq = [self.reps_sq[m] for m in members]
+
+    def search(self, x, L):
+        """
+        Find the (approximately) L closest representatives of each embedding
+
+        :param x: (B x D) embeddings
+        :param L: the number of representatives to return per embedding
+        :return: the (B x L) distances and rep indexes, padded with inf and -1 if fewer than L candidates were found
+        """
+        assert self.lists is not None, "build() the index before searching it"
+
+        # the closest lists to each embedding, (normalised embeddings and reps for cosine distance)
+        if self.dist == 'cos':
+            x = torch.nn.functional.normalize(x, dim=1)
+        list_dists = euclidean_distance(x, self.list_centroids)
+        _, probes = list_dists.topk(min(self.n_probe, len(self.list_centroids)), dim=1, largest=False)
+
+        # score each probed list against just the embeddings probing it, (B x n_probe x max_list_size)
+        n_probe = probes.size(1)
+        dists = torch.full((len(x), n_probe, self.lists.size(1)), float('inf'), dtype=x.dtype, device=x.device)
+        flat_probes = probes.reshape(-1)
+        rows = torch.arange(len(x), device=x.device).repeat_interleave(n_probe)
+        slots = torch.arange(n_probe, device=x.device).repeat(len(x))
+        order = torch.argsort(flat_probes)
+        counts = torch.bincount(flat_probes, minlength=len(self.list_reps)).tolist()
+
+        start = 0
+        for list_idx, count in enumerate(counts):
+            if count == 0:
+                continue
+            pairs = order[start:start + count]
+            start += count
+            xs = x[rows[pairs]]
+            dots = torch.mm(xs, self.list_reps[list_idx].t())
+            if self.dist == 'cos':
+                list_dists = 1 - dots
+            else:
+                list_dists = (self.list_sq[list_idx] + (xs ** 2).sum(1, keepdim=True) - 2 * dots).clamp(min=0)
+            dists[rows[pairs], slots[pairs], :list_dists.size(1)] = list_dists
+
+        # the rep indexes of the candidates, (B x n_probe*max_list_size)
+        candidates = self.lists[probes].view(len(x), -1)
+        dists = dists.view(len(x), -1)
+
+        L = min(L, dists.size(1))
+        dists, top = dists.topk(L, dim=1, largest=False)
+        indexes = candidates.gather(1, top).masked_fill(torch.isinf(dists), -1)
+
+        return dists, indexes